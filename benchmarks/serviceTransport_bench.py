@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+    NAME
+
+        serviceTransport_bench.py
+
+    SYNOPSIS
+
+        serviceTransport_bench.py   [--calls <N>]                   \\
+                                    [--threads <T>]                 \\
+                                    [--pfdcm <PACserviceIP:port>]
+
+    DESCRIPTION
+
+    Compare the number of 'pfdcm' service calls per second that the
+    'pooled' and 'pfurl' transports of 'pacsretrieve.py' achieve.
+
+    Unless a --pfdcm is given, a minimal local stand-in service that
+    answers every message with {"status": true} is started, so that
+    the measurement reflects transport overhead only.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pacsretrieve.pacsretrieve import PacsRetrieveApp
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version    = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # Headers and body in a single write, as a real service would do
+        str_body    = json.dumps({'status': True})
+        str_reply   = 'HTTP/1.1 200 OK\r\n'                        + \
+                      'Content-Type: application/json\r\n'         + \
+                      'Content-Length: %d\r\n\r\n%s' % (len(str_body), str_body)
+        self.wfile.write(str_reply.encode())
+
+    def log_message(self, *args):
+        pass
+
+def transport_bench(str_pfdcm, str_transport, calls, threads):
+    """
+    Return the calls per second for <calls> service calls over <threads>.
+    """
+    app                         = PacsRetrieveApp()
+    app.str_pfdcm               = str_pfdcm
+    app.str_serviceTransport    = str_transport
+    app.b_serviceCallQuiet      = True
+    app.b_pfurlQuiet            = True
+    app.maxConcurrentStatusChecks   = threads
+    d_msg                       = {
+        'action':   'PACSinteract',
+        'meta': {
+            'do':   'retrieveStatus',
+            'on':   {'series_uid': '1.2.3'}
+        }
+    }
+    startTime                   = time.time()
+    app.serviceCall_fanOut([d_msg] * calls, workers = threads)
+    elapsed                     = time.time() - startTime
+    if app.servicePool:
+        app.servicePool.close()
+    return calls / elapsed
+
+if __name__ == "__main__":
+    parser  = argparse.ArgumentParser(description = 'pfdcm service transport benchmark')
+    parser.add_argument('--calls',   type = int, default = 500)
+    parser.add_argument('--threads', type = int, default = 1)
+    parser.add_argument('--pfdcm',   type = str, default = '')
+    args    = parser.parse_args()
+
+    str_pfdcm   = args.pfdcm
+    if not len(str_pfdcm):
+        server      = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        str_pfdcm   = '127.0.0.1:%d' % server.server_address[1]
+
+    for str_transport in ['pfurl', 'pooled']:
+        rate = transport_bench(str_pfdcm, str_transport, args.calls, args.threads)
+        print('%-10s %10.1f calls/s  (%d calls, %d threads)' % 
+                (str_transport, rate, args.calls, args.threads))
@@ -22,15 +22,45 @@ str_synposis = """
                         [--version]                             \\
                         [--msg <jsonMsgString>]                 \\
                         [--action retrieve|query]               \\
+                        [--serviceTransport pooled|pfurl]       \\
+                        [--bulkMessages]                        \\
+                        [--jsonBackend json|orjson]             \\
                         # For retrieve...                       \\
                         [--priorHitsTable <hitsTable>]          \\
+                        [--priorHitsDB <hitsDB>]                \\
                         [--indexList <commaseparatedlist>]      \\
+                        [--select <expression>]                 \\
+                        [--studyRetrieve]                       \\
+                        [--retrieveOrder <order>]               \\
+                        [--maxInstancesInFlight <N>]            \\
+                        [--maxConcurrentRetrieves <N>]          \\
+                        [--maxConcurrentStatusChecks <N>]       \\
+                        [--pipelineWorkers <N>]                 \\
+                        [--jpgPreview]                          \\
+                        [--previewWorkers <N>]                  \\
+                        [--previewEngine native|dcmtk]          \\
+                        [--previewSamples <K>]                  \\
+                        [--previewLayout strip|mosaic]          \\
+                        [--previewColumns <C>]                  \\
+                        [--previewMaxTiles <T>]                 \\
+                        [--pollIntervalMin <seconds>]           \\
+                        [--pollIntervalMax <seconds>]           \\
+                        [--instancesPerSecond <rate>]           \\
+                        [--retrieveTimeout <seconds>]           \\
+                        [--journal <journalFile>]               \\
+                        [--cacheDir <cacheDir>]                 \\
+                        [--cacheMaxGB <size>]                   \\
+                        [--pullMode service|local]              \\
+                        [--smdbDir <smdbDir>]                   \\
+                        [--pullWorkers <N>]                     \\
                         # For query...                          \\
                         [--patientID <patientID>]               \\
                         [--PACSservice <PACSservice>]           \\
                         [--summaryKeys <keylist>]               \\
                         [--summaryFile <summaryFile>]           \\
+                        [--summaryFormat text|tsv|csv|parquet]  \\
                         [--resultFile <resultFile>]             \\
+                        [--hitsDB <hitsDB>]                     \\
                         [--numberOfHitsFile <numberOfHitsFile>] \\
                         # Mandatory positional args             \\                       
                         <inputdir>
@@ -118,6 +148,39 @@ str_args = """
 
         The actual action to perform. Default is 'retrieve'.
 
+    --serviceTransport pooled|pfurl
+
+        How to send messages to 'pfdcm'. The 'pooled' transport keeps a
+        pool of persistent (keep-alive) HTTP connections to 'pfdcm' that
+        is reused by all calls, from all threads, for the whole run. The
+        'pfurl' transport creates a new 'pfurl' object (and connection) per
+        message. Path type messages (such as 'pullPath') are always sent
+        via 'pfurl', and the 'pooled' transport falls back to 'pfurl' if
+        it cannot connect to 'pfdcm'. A call that fails once sent is not
+        sent again, as that could repeat a 'retrieve'. Default is 'pfurl'.
+
+    --bulkMessages
+
+        If specified, send the per-series 'retrieve' and 'retrieveStatus'
+        messages of a batch as a single message that carries the
+        list of per-series 'meta' dictionaries in a 'bulk' key, and expect
+        a single response that holds the list of per-series results in a
+        'bulk' key. If 'pfdcm' cannot be reached, or rejects a bulk message
+        as a whole (a False 'status' and no 'bulk' list), this app falls
+        back to per-series messages for that action for the rest of the
+        run. Any other failure of a bulk message fails each of its series,
+        which are not sent again. 'pullPath' messages are processed by
+        'pfurl' on this side and are always sent per series.
+
+    --jsonBackend json|orjson
+
+        The JSON library used to parse responses from 'pfdcm' and to
+        write the <resultFile>. The <resultFile> is always written record
+        by record, so that only one hit is serialized in memory at a time.
+        With 'json' the file is indented as before; the (optional, and
+        faster) 'orjson' backend writes each record on a single line. If
+        'orjson' is not installed, 'json' is used. Default is 'json'.
+
     --pfurlQuiet
 
         If specified, do not show interal pfurl communication
@@ -148,9 +211,30 @@ str_args = """
 
         The name of the file in the <outputdir> to contain the summary report.
 
+    --summaryFormat text|tsv|csv|parquet
+
+        The format of the summary reports. 'text' is the fixed width
+        (60 characters per column) report; 'tsv' and 'csv' write one 
+        (unpadded) line per hit, with the summary keys as the header. 
+        'parquet' writes a columnar Parquet file with one (string) column
+        per summary key, and needs the optional 'pyarrow' package. Any 
+        other format, or 'parquet' without 'pyarrow', is an error. Default
+        is 'text'.
+
     --resultFile <resultFile>]
 
         The name of the file in the <outputdir> to contain the results.
+        An index of the byte offsets of the series and study hits in
+        <resultFile> is saved next to it, as <resultFile>.index.
+
+    --hitsDB <hitsDB>]
+
+        The name of an SQLite database in the <outputdir> to contain the
+        hits. The series and study hits are kept in a 'series' and a
+        'study' table, with one column per key, the position of the hit
+        in the results ('row'), and the hit itself as JSON ('hit'). The
+        PatientID, StudyInstanceUID, SeriesInstanceUID, Modality and
+        date columns are indexed.
     
     --numberOfHitsFile <numberOfHitsFile>]
 
@@ -163,10 +247,219 @@ str_args = """
 
         The JSON table of hits from a prior call to pacsretrieve.
 
+        Only the series in <indexList> are read from the table. If the
+        <hitsTable>.index file saved by the query is next to the table,
+        each series is read directly at its offset; otherwise the table
+        is streamed with the (optional) 'ijson' package, and, failing
+        that, read in full.
+
+    --priorHitsDB <hitsDB>
+
+        The SQLite database of hits (see --hitsDB) from a prior call to
+        pacsretrieve. If given, series are selected and read from it, 
+        instead of from the <hitsTable>.
+
     --indexList <commaseparatedlist>      
 
         A comma separated list of series in the <hitsTable> to actually
-        retrieve.
+        retrieve. Duplicates are dropped.
+
+    --select <expression>
+
+        Retrieve the series of the <hitsDB> or <hitsTable> that match
+        <expression>, for example
+
+            --select 'Modality==MR and SeriesDescription~"T1" and StudyDate>=20180101'
+
+        Terms compare the value of a key with '==', '!=', '<', '<=', '>',
+        '>=' or '~' (a regular expression search), and are combined with
+        'and', 'or', 'not' and parentheses. Values with spaces or special
+        characters are quoted. Ordering comparisons are numeric if the 
+        value is a number, and lexical otherwise. If an <indexList> is 
+        also given, only the series in it that match are retrieved.
+
+    --studyRetrieve
+
+        If specified, the series to retrieve are grouped by study, and a
+        study of which all series in the prior hits are to be retrieved
+        is retrieved with a single study level message ('on': {'study_uid':
+        <StudyInstanceUID>}) instead of one message per series. Status
+        checks and pulls remain per series. The number of series of each
+        study is taken from the <hitsDB>, or from the <hitsTable> (or its
+        index); if it is not known, series are retrieved one by one.
+
+    --retrieveOrder index|smallest|largest|roundrobin
+
+        The order in which retrieves are started: in <indexList> order
+        ('index'), by number of instances ('NumberOfSeriesRelatedInstances'
+        in the hits) with the 'smallest' or 'largest' first, or one 
+        retrieve per study in turn ('roundrobin'). Default is 'index'.
+
+    --maxInstancesInFlight <N>
+
+        The maximum total number of instances of the retrieves in flight
+        at a time. Further retrieves are started, in <retrieveOrder>, as
+        earlier ones complete (or fail to start); a retrieve larger than
+        <N> is started on its own. Series of unknown size count as 0. The
+        <retrieveTimeout> is a deadline for the retrieve as a whole, so
+        series still waiting for the budget by then are not started.
+        Default is 0, for no limit (all retrieves are started at once).
+
+    --maxConcurrentRetrieves <N>
+
+        The maximum number of retrieve requests to send concurrently to
+        'pfdcm' when initiating a retrieve. Responses are kept in the order
+        of <indexList>, and a failure on one series is reported without
+        aborting the others. Default is 1 (sequential).
+
+    --maxConcurrentStatusChecks <N>
+
+        The maximum number of 'retrieveStatus' requests to send concurrently
+        to 'pfdcm' in each polling cycle. With <N> at least the number of
+        pending series, a cycle costs about one round trip regardless of
+        the size of the batch. Default is 1 (sequential).
+
+    --pipelineWorkers <N>
+
+        Series are pulled to the <outputdir> (and previewed) as soon as
+        'pfdcm' reports them as received, while other series are still
+        in flight. This sets how many series can be pulled and previewed
+        at the same time. Default is 4.
+
+    --jpgPreview
+
+        If specified, generate a 'preview.jpg' in each pulled series
+        directory.
+
+    --previewWorkers <N>
+
+        The number of worker processes, shared by all series, that convert
+        DICOM files to jpg thumbnails for the preview. Thumbnails are resized
+        in a few batched 'mogrify' calls, and the time taken by each step is
+        reported per directory. A value of 0 uses one worker per CPU.
+        Default is 1, which generates previews in-process, without a 
+        pool of worker processes.
+
+    --previewEngine native|dcmtk
+
+        The 'native' engine decodes, windows and downsamples the pixel
+        data in-process (with pydicom, NumPy and Pillow) and composes the
+        preview in memory, so no full resolution intermediate images are
+        written. Files that it cannot decode (typically due to their
+        transfer syntax) are handed to the 'dcmtk' engine, which uses
+        'dcmj2pnm' and ImageMagick. If pydicom, NumPy or Pillow is not
+        installed, the 'dcmtk' engine is used throughout. Default is 
+        'dcmtk', as before the 'native' engine was added.
+
+    --previewSamples <K>
+
+        If non-zero, render only <K> representative slices of each series
+        into its preview, evenly spaced over the series in InstanceNumber
+        order (as read from the DICOM headers only). This makes the cost of
+        a preview constant, rather than linear in the number of slices.
+        Default is 0, i.e. render every slice.
+
+    --previewLayout strip|mosaic
+
+        Lay out the thumbnails of the preview either as one vertical
+        'strip' (one tile per row) or as a 'mosaic' grid of <C> columns.
+        With either engine, tiles are in InstanceNumber order. Default is
+        'strip'.
+
+    --previewColumns <C>
+
+        The number of columns of a 'mosaic' preview. Default is 8.
+
+    --previewMaxTiles <T>
+
+        A preview holds at most <T> tiles, sampled as for --previewSamples.
+        This bounds the size of the preview canvas, and so the memory used
+        by a preview (by either engine), regardless of the number of
+        slices. Default is 256, which at the default tile size is a canvas
+        of at most about 7 MB. A value of 0 means no limit, in which case
+        the memory used grows with the number of slices.
+
+    Preview generation is incremental: a '.manifest.json' in the 'jpg'
+    dir of a series records the size and mtime of the DICOM file behind
+    each thumbnail. A rerun only converts new or changed DICOM files, and
+    only rebuilds 'preview.jpg' if its inputs have changed.
+
+    --pollIntervalMin <seconds>
+    --pollIntervalMax <seconds>
+
+        The shortest and longest wait between two status checks on the
+        same pending series. The first wait on a series is its expected
+        completion time (see --instancesPerSecond) clamped to this range;
+        each further wait doubles, with some random jitter, up to
+        <pollIntervalMax>. Defaults are 0.5 and 30 seconds.
+
+    --instancesPerSecond <rate>
+
+        The assumed rate at which the PACS delivers DICOM instances, used
+        with the 'NumberOfSeriesRelatedInstances' of a series in the
+        <hitsTable> to estimate when that series will be complete.
+        Default is 10.
+
+    --retrieveTimeout <seconds>
+
+        Stop waiting on pending retrieves <seconds> after the retrieve 
+        starts. This bounds the retrieve as a whole: series that have not
+        completed by then, and series that were not yet started because
+        of --maxInstancesInFlight, are reported and skipped. A value of 0
+        waits forever. Default is 3600.
+
+    --journal <journalFile>
+
+        The name of a journal file in the <outputdir> in which the state
+        of each series ('initiated', 'received', 'pulled', 'previewed')
+        is recorded, one appended line per change, as the retrieve goes.
+        A retrieve that is run again on the same <outputdir> (after being
+        interrupted, say) resumes from the journal: a series that was 
+        pulled, and whose pull dir holds the expected number of files, 
+        is not retrieved or pulled again (only previewed, if that is 
+        still to be done), and a series whose retrieve was initiated is 
+        polled for, without initiating it again. The journal is off by 
+        default (an empty <journalFile>). Note that, as it is in the
+        <outputdir>, it is part of the output of the plugin, and that a 
+        run in an <outputdir> that holds a journal skips the series that
+        it records as pulled.
+
+    --cacheDir <cacheDir>
+
+        A DICOM cache directory, shared by retrieves across runs (and 
+        feeds). A series that is in the cache, with the expected number
+        of instances, is not retrieved from the PACS at all: its files 
+        are linked into the output dir (as hardlinks, or reflinks or 
+        copies across filesystems). Series that are pulled are added to
+        the cache. Cached files are made read only, which also holds for
+        their links in output dirs.
+
+    --cacheMaxGB <size>
+
+        Once the <cacheDir> holds more than <size> GB, the least recently
+        used series are evicted from it. Default is 0, for no limit.
+
+    --pullMode service|local
+
+        How retrieved series are pulled to the <outputdir>. In 'service'
+        mode (the default) 'pfdcm' is asked to copy each series. In 
+        'local' mode, where this plugin shares the filesystem of 'pfdcm', 
+        the unpack dir of each series is looked up (once) in the 'pfdcm'
+        smdb and its files are pulled by this plugin directly, as hard 
+        links where the dirs are on the same filesystem and else with
+        in-kernel copies. The bytes pulled and throughput are reported.
+
+    --smdbDir <smdbDir>
+
+        In 'local' pull mode, the log dir of the 'pfdcm' smdb, where the
+        unpack dirs of series are recorded. Default is '/home/dicom/log'.
+        The 'local' pull mode is refused if <smdbDir> is not an smdb log
+        dir.
+
+    --pullWorkers <N>
+
+        In 'local' pull mode, the number of threads, shared by all series,
+        that pull files. Default is 8.
 
     <inputdir>
 
@@ -181,6 +474,7 @@ str_args = """
 import os
 import sys
 import json
+import argparse
 import pprint
 import pypx
 import pfurl
@@ -192,10 +486,1234 @@ import glob
 import subprocess
 import re
 import datetime
+import hashlib
+import csv
+import sqlite3
+import random
+import concurrent.futures
+import multiprocessing
+import threading
+import queue
+import select
+import http.client
+import collections.abc
+
+# Optional dependencies of the in-process ('native') preview engine
+try:
+    import numpy
+    import pydicom
+    from PIL import Image
+except ImportError:
+    numpy   = None
+    pydicom = None
+    Image   = None
+
+# Optional dependency of the 'parquet' summary format
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Optional incremental JSON parser, used to read hits tables without an index
+try:
+    import ijson
+except ImportError:
+    ijson   = None
+
+# The service's DB of unpacked series, read directly by the 'local' pull mode
+try:
+    from pypx import smdb
+except ImportError:
+    smdb    = None
+
+# File locking of the shared DICOM cache (POSIX)
+try:
+    import fcntl
+except ImportError:
+    fcntl   = None
+
+# Optional faster JSON backend
+try:
+    import orjson
+except ImportError:
+    orjson  = None
 
 # import the Chris app superclass
 from chrisapp.base import ChrisApp
 
+class HitsTable(object):
+    """
+    A compact, column-wise table of query hits.
+
+    Each hit returned by 'pfdcm' is a dictionary of {'label', 'tag', 
+    'value'} dictionaries, one per DICOM attribute, and the label and tag
+    of an attribute are repeated in every hit. Here they are kept once, in
+    a schema shared by all hits ({key: {'label', 'tag'}}), and only the 
+    values are kept, in one list per key. A cell that does not fit the 
+    schema is kept as is, on the side.
+
+    Hits are looked at through (read only) HitsRow views, that look like 
+    the original dictionaries; row_dict() converts a hit back to the 
+    original layout, for output.
+    """
+
+    missing = object()
+
+    def __init__(self, l_hits = None):
+        self.d_schema   = {}
+        self.d_column   = {}
+        self.d_cell     = {}
+        self.rows       = 0
+        for d_hit in l_hits or []:
+            self.row_append(d_hit)
+
+    def row_append(self, d_hit):
+        """
+        Append the hit dictionary <d_hit>, and return its row.
+        """
+        row             = self.rows
+        for key, cell in d_hit.items():
+            if key not in self.d_schema:
+                self.d_schema[key]  = None
+                if isinstance(cell, dict) and sorted(cell) == ['label', 'tag', 'value']:
+                    self.d_schema[key]  = {'label': cell['label'], 'tag': cell['tag']}
+                self.d_column[key]  = [self.missing] * row
+            d_attr      = self.d_schema[key]
+            if  d_attr and isinstance(cell, dict) and len(cell) == 3 and 'value' in cell \
+                and cell.get('label') == d_attr['label'] and cell.get('tag') == d_attr['tag']:
+                self.d_column[key].append(cell['value'])
+            else:
+                self.d_column[key].append(self.missing)
+                self.d_cell[(row, key)] = cell
+        self.rows      += 1
+        if len(d_hit) < len(self.d_column):
+            for l_column in self.d_column.values():
+                if len(l_column) < self.rows: l_column.append(self.missing)
+        return row
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, row):
+        if row < 0: row += self.rows
+        if not 0 <= row < self.rows:
+            raise IndexError('hits table row %d out of range' % row)
+        return HitsRow(self, row)
+
+    def __iter__(self):
+        for row in range(self.rows):
+            yield HitsRow(self, row)
+
+    def value_get(self, row, key):
+        """
+        Return the 'value' of <key> in <row>.
+        """
+        value   = self.d_column[key][row]
+        if value is self.missing:
+            return self.d_cell[(row, key)]['value']
+        return value
+
+    def cell_get(self, row, key):
+        """
+        Return the {'label', 'tag', 'value'} dictionary of <key> in <row>.
+        """
+        value   = self.d_column[key][row]
+        if value is self.missing:
+            return self.d_cell[(row, key)]
+        return {'label': self.d_schema[key]['label'], 'tag': self.d_schema[key]['tag'], 'value': value}
+
+    def row_keys(self, row):
+        """
+        Return the keys present in <row>.
+        """
+        return [key for key, l_column in self.d_column.items()
+                if l_column[row] is not self.missing or (row, key) in self.d_cell]
+
+    def row_dict(self, row):
+        """
+        Return <row> as a hit dictionary in the original layout.
+        """
+        return {key: self.cell_get(row, key) for key in self.row_keys(row)}
+
+class HitsRow(collections.abc.Mapping):
+    """
+    A read only, dictionary like view of one row of a HitsTable.
+    """
+
+    __slots__   = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table  = table
+        self.row    = row
+
+    def __getitem__(self, key):
+        try:
+            return self.table.cell_get(self.row, key)
+        except (KeyError, IndexError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.table.row_keys(self.row))
+
+    def __len__(self):
+        return len(self.table.row_keys(self.row))
+
+    def value(self, key):
+        """
+        Return the 'value' of <key>, without building its dictionary.
+        """
+        try:
+            return self.table.value_get(self.row, key)
+        except (KeyError, IndexError, TypeError):
+            raise KeyError(key)
+
+    def dict_get(self):
+        return self.table.row_dict(self.row)
+
+class HitsSelector(object):
+    """
+    A series selection expression over hits, such as
+
+        Modality==MR and SeriesDescription~"T1" and StudyDate>=20180101
+
+    Terms compare the value of a key with '==', '!=', '<', '<=', '>', 
+    '>=' or '~' (a regular expression search), and are combined with 
+    'and', 'or', 'not' and parentheses. Values may be quoted. Ordering
+    comparisons are numeric if the value is a number (and then never
+    match a non-numeric hit value), otherwise lexical. A term on a key 
+    that a hit does not have does not match.
+
+    On a HitsTable, each term is evaluated once per distinct value of its
+    key, against a per-column index of {value: [rows]}. The expression 
+    can also be compiled to an SQL condition for a HitsDBWriter database.
+    """
+
+    token_re    = re.compile(r"""\s*(?:(\()|(\))|(==|!=|>=|<=|>|<|~)|"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'|([^\s()=!<>~"']+))""")
+    l_op        = ['==', '!=', '>=', '<=', '>', '<', '~']
+
+    def __init__(self, str_select):
+        self.str_select = str_select
+        self.d_index    = {}
+        self.l_token    = self.tokens_get(str_select)
+        self.tree       = self.expr_parse()
+        if len(self.l_token):
+            self.error('unexpected "%s"' % self.l_token[0][1])
+
+    def error(self, str_message):
+        raise ValueError('--select "%s": %s' % (self.str_select, str_message))
+
+    def tokens_get(self, str_select):
+        """
+        Return the list of (kind, text) tokens of <str_select>.
+        """
+        l_token     = []
+        pos         = 0
+        str_select  = str_select.rstrip()
+        while pos < len(str_select):
+            match   = self.token_re.match(str_select, pos)
+            if not match:
+                self.error('cannot parse "%s"' % str_select[pos:])
+            pos     = match.end()
+            lparen, rparen, op, dquote, squote, word = match.groups()
+            if lparen:                  l_token.append(('(', lparen))
+            elif rparen:                l_token.append((')', rparen))
+            elif op:                    l_token.append(('op', op))
+            elif dquote is not None:    l_token.append(('value', re.sub(r'\\(.)', r'\1', dquote)))
+            elif squote is not None:    l_token.append(('value', re.sub(r'\\(.)', r'\1', squote)))
+            elif word.lower() in ['and', 'or', 'not']:
+                                        l_token.append((word.lower(), word))
+            else:                       l_token.append(('word', word))
+        return l_token
+
+    def token_next(self, *l_kind):
+        if len(self.l_token) and self.l_token[0][0] in l_kind:
+            return self.l_token.pop(0)
+        return None
+
+    def expr_parse(self):
+        tree        = self.term_parse()
+        while self.token_next('or'):
+            tree    = ('or', tree, self.term_parse())
+        return tree
+
+    def term_parse(self):
+        tree        = self.factor_parse()
+        while self.token_next('and'):
+            tree    = ('and', tree, self.factor_parse())
+        return tree
+
+    def factor_parse(self):
+        if self.token_next('not'):
+            return ('not', self.factor_parse())
+        if self.token_next('('):
+            tree    = self.expr_parse()
+            if not self.token_next(')'): self.error('missing ")"')
+            return tree
+        key         = self.token_next('word')
+        op          = self.token_next('op')
+        value       = self.token_next('word', 'value')
+        if not (key and op and value):
+            self.error('expected <key><op><value>')
+        if op[1] == '~':
+            try:
+                return ('cmp', key[1], op[1], re.compile(value[1]))
+            except re.error as e:
+                self.error('bad regular expression "%s" (%s)' % (value[1], e))
+        return ('cmp', key[1], op[1], value[1])
+
+    def keys(self, tree = None):
+        """
+        Return the set of keys referenced by the expression.
+        """
+        tree        = tree or self.tree
+        if tree[0] == 'cmp':    return set([tree[1]])
+        return set().union(*[self.keys(node) for node in tree[1:]])
+
+    @staticmethod
+    def value_compare(value, str_op, literal):
+        """
+        Return whether the hit <value> compares <str_op> to <literal>.
+        """
+        if value is None:
+            return False
+        str_value   = '%s' % value
+        if str_op == '~':   return bool(literal.search(str_value))
+        if str_op == '==':  return str_value == literal
+        if str_op == '!=':  return str_value != literal
+        try:
+            a, b    = str_value, float(literal)
+            try:
+                a   = float(str_value)
+            except ValueError:
+                return False
+        except ValueError:
+            a, b    = str_value, literal
+        if str_op == '<':   return a <  b
+        if str_op == '<=':  return a <= b
+        if str_op == '>':   return a >  b
+        return a >= b
+
+    def column_index(self, table, key):
+        """
+        Return (building it once) the {value: [rows]} index of <key> in
+        the HitsTable <table>.
+        """
+        if key not in self.d_index:
+            d_rows  = {}
+            if key in table.d_column:
+                for row in range(len(table)):
+                    try:
+                        value   = table.value_get(row, key)
+                    except (KeyError, TypeError):
+                        continue
+                    if value is None:
+                        continue
+                    value   = json.dumps(value) if isinstance(value, (dict, list)) else '%s' % value
+                    d_rows.setdefault(value, []).append(row)
+            self.d_index[key]   = d_rows
+        return self.d_index[key]
+
+    def rows_select(self, table, tree = None):
+        """
+        Return the set of rows of the HitsTable <table> that match.
+        """
+        tree        = tree or self.tree
+        if tree[0] == 'and':
+            return self.rows_select(table, tree[1]) & self.rows_select(table, tree[2])
+        if tree[0] == 'or':
+            return self.rows_select(table, tree[1]) | self.rows_select(table, tree[2])
+        if tree[0] == 'not':
+            return set(range(len(table))) - self.rows_select(table, tree[1])
+        str_op, key, literal    = tree[2], tree[1], tree[3]
+        d_rows      = self.column_index(table, key)
+        if str_op == '==':
+            return set(d_rows.get(literal, []))
+        s_row       = set()
+        for value, l_row in d_rows.items():
+            if self.value_compare(value, str_op, literal):
+                s_row.update(l_row)
+        return s_row
+
+    def sql_compile(self, s_column, tree = None):
+        """
+        Return the SQL condition (and its parameters) of the expression,
+        over a table with the columns in <s_column>. '==' and '!=' are
+        plain SQL comparisons (that can use the indexes); the others 
+        call the 'hits_compare' function, see sqlFunctions_register().
+        """
+        tree        = tree or self.tree
+        if tree[0] in ['and', 'or']:
+            str_a, l_a  = self.sql_compile(s_column, tree[1])
+            str_b, l_b  = self.sql_compile(s_column, tree[2])
+            return '(%s %s %s)' % (str_a, tree[0].upper(), str_b), l_a + l_b
+        if tree[0] == 'not':
+            str_a, l_a  = self.sql_compile(s_column, tree[1])
+            return '(NOT COALESCE(%s, 0))' % str_a, l_a
+        str_op, key, literal    = tree[2], tree[1], tree[3]
+        if key not in s_column:
+            return '0', []
+        str_column  = HitsDBWriter.name_quote(key)
+        if str_op == '==':  return '%s = ?' % str_column, [literal]
+        if str_op == '!=':  return '%s <> ?' % str_column, [literal]
+        if str_op == '~':   literal = literal.pattern
+        return 'hits_compare(%s, ?, ?)' % str_column, [str_op, literal]
+
+    @classmethod
+    def sqlFunctions_register(cls, db):
+        """
+        Register the 'hits_compare(value, op, literal)' SQL function.
+        """
+        d_re        = {}
+        def hits_compare(value, str_op, literal):
+            if str_op == '~':
+                if literal not in d_re: d_re[literal] = re.compile(literal)
+                literal = d_re[literal]
+            return 1 if cls.value_compare(value, str_op, literal) else 0
+        db.create_function('hits_compare', 3, hits_compare)
+
+class JSONStreamWriter(object):
+    """
+    Write a JSON document to a binary file, one record at a time.
+
+    Dictionaries are walked key by key (in sorted order) and lists
+    element by element; each list element (and each scalar) is a
+    record that is serialized and written on its own. Peak memory thus
+    tracks the largest record, rather than the whole document.
+
+    With the 'json' backend the output is identical to 
+
+        json.dumps(<document>, sort_keys = True, indent = 4)
+
+    while the 'orjson' backend writes each record on a single line.
+
+    Each record of a list is also passed to the listeners registered for
+    the key path of that list, e.g. {('query', 'data'): [fn, ...]}, so
+    that other reports can be fed in the same pass. If <fd> is None, the
+    document is only walked for the listeners, and nothing is serialized.
+
+    For the lists at <indexPaths>, the [offset, length] in bytes of each
+    written record is kept in d_index, keyed on the path.
+
+    A HitsTable is written as a list of hits, and each of its rows is
+    converted back to a hit dictionary only as it is written.
+    """
+
+    def __init__(self, fd, **kwargs):
+        self.fd             = fd
+        self.str_backend    = 'json'
+        self.indent         = 4
+        self.d_listeners    = {}
+        self.d_index        = {}
+        self.offset         = 0
+        for k, v in kwargs.items():
+            if k == 'backend':      self.str_backend    = v
+            if k == 'indent':       self.indent         = v
+            if k == 'listeners':    self.d_listeners    = v
+            if k == 'indexPaths':   self.d_index        = {path: [] for path in v}
+
+    def bytes_write(self, str_text):
+        """
+        Write the (string) <str_text>, unless only walking.
+        """
+        if self.fd:
+            self.offset    += self.fd.write(str_text.encode())
+
+    def record_dumps(self, record, level):
+        """
+        Return the (bytes) serialization of <record>, nested <level> deep.
+        """
+        if self.str_backend == 'orjson':
+            return orjson.dumps(record, option = orjson.OPT_SORT_KEYS)
+        str_record  = json.dumps(record, sort_keys = True, indent = self.indent)
+        return str_record.replace('\n', '\n' + ' ' * (self.indent * level)).encode()
+
+    def value_write(self, value, level = 0, b_record = False, path = ()):
+        """
+        Write <value>, nested <level> deep at key <path>.
+        """
+        if isinstance(value, HitsTable) and not len(value):
+            value   = []
+        if b_record or not isinstance(value, (dict, list, HitsTable)) or not len(value):
+            if self.fd:
+                if isinstance(value, HitsRow): value = value.dict_get()
+                length          = self.fd.write(self.record_dumps(value, level))
+                if b_record and path in self.d_index:
+                    self.d_index[path].append([self.offset, length])
+                self.offset    += length
+            return
+        str_indent  = '\n' + ' ' * (self.indent * (level + 1))
+        if isinstance(value, dict):
+            self.bytes_write('{')
+            for i, key in enumerate(sorted(value)):
+                self.bytes_write('%s%s%s: ' % (',' if i else '', str_indent, json.dumps(key)))
+                self.value_write(value[key], level + 1, path = path + (key,))
+            self.bytes_write('\n' + ' ' * (self.indent * level) + '}')
+        else:
+            l_listener  = self.d_listeners.get(path, [])
+            self.bytes_write('[')
+            for i, record in enumerate(value):
+                self.bytes_write('%s%s' % (',' if i else '', str_indent))
+                self.value_write(record, level + 1, b_record = True, path = path)
+                for listener in l_listener:
+                    listener(record)
+            self.bytes_write('\n' + ' ' * (self.indent * level) + ']')
+
+class SummaryReportWriter(object):
+    """
+    Write a summary report of hits, one row per entry, to a file as the
+    entries are added.
+
+    The 'text' format pads each value to 60 characters and writes the
+    header with the first row, so that a report without entries is an
+    empty file. The 'tsv' and 'csv' formats write the header up front.
+    The 'parquet' format collects the values per column and writes them
+    out as a row group every <rowGroupSize> rows.
+    """
+
+    l_formats   = ['text', 'tsv', 'csv', 'parquet']
+
+    def __init__(self, str_file, l_keys, **kwargs):
+        self.str_file       = str_file
+        self.l_keys         = l_keys
+        self.str_format     = 'text'
+        self.rowGroupSize   = 10000
+        self.rows           = 0
+        self.valueGet       = lambda d_entry, key: d_entry[key]['value']
+        for k, v in kwargs.items():
+            if k == 'valueGet':     self.valueGet       = v
+            if k == 'format':       self.str_format     = v
+            if k == 'rowGroupSize': self.rowGroupSize   = v
+        SummaryReportWriter.format_check(self.str_format)
+
+        self.fd             = None
+        if self.str_format == 'parquet':
+            self.schema     = pyarrow.schema([(key, pyarrow.string()) for key in self.l_keys])
+            self.l_columns  = [[] for key in self.l_keys]
+            self.parquet    = pyarrow.parquet.ParquetWriter(self.str_file, self.schema)
+        else:
+            self.fd         = open(self.str_file, 'w', newline = '')
+        if self.str_format in ['tsv', 'csv']:
+            self.csv        = csv.writer(   self.fd, 
+                                            delimiter       = '\t' if self.str_format == 'tsv' else ',',
+                                            lineterminator  = '\n')
+            self.csv.writerow(self.l_keys)
+
+    @staticmethod
+    def format_check(str_format):
+        """
+        Raise a ValueError if <str_format> is not a known format, or is
+        'parquet' and pyarrow is not installed.
+        """
+        if str_format not in SummaryReportWriter.l_formats:
+            raise ValueError('unknown summary format "%s", expected one of %s' % 
+                                (str_format, '|'.join(SummaryReportWriter.l_formats)))
+        if str_format == 'parquet' and not pyarrow:
+            raise ValueError('the parquet summary format needs pyarrow, which is not installed')
+
+    def rowGroup_write(self):
+        """
+        Write the collected parquet columns as a row group.
+        """
+        if len(self.l_columns[0]):
+            self.parquet.write_table(pyarrow.Table.from_arrays(
+                        [pyarrow.array(l_column, type = pyarrow.string()) 
+                            for l_column in self.l_columns],
+                        schema = self.schema))
+            self.l_columns  = [[] for key in self.l_keys]
+
+    def row_add(self, d_entry):
+        """
+        Write (or, for parquet, collect) the summary row of <d_entry>.
+        """
+        l_value     = ['%s' % self.valueGet(d_entry, key) for key in self.l_keys]
+        if self.str_format == 'text':
+            if not self.rows:
+                self.fd.write(''.join(['%-60s\t' % key for key in self.l_keys]))
+            self.fd.write('\n' + ''.join(['%-60s\t' % value for value in l_value]))
+        elif self.str_format == 'parquet':
+            for l_column, value in zip(self.l_columns, l_value):
+                l_column.append(value)
+            if len(self.l_columns[0]) >= self.rowGroupSize:
+                self.rowGroup_write()
+        else:
+            self.csv.writerow(l_value)
+        self.rows  += 1
+
+    def close(self):
+        if self.str_format == 'parquet':
+            self.rowGroup_write()
+            self.parquet.close()
+        else:
+            self.fd.close()
+
+class HitsDBWriter(object):
+    """
+    Write query hits to an SQLite database as they are added, into one
+    table per report ('series' and 'study'). Each table has a 'row' 
+    (the position of the hit in its report), a 'hit' (the hit as JSON) 
+    and one column per key, with the value of the key. Columns are added
+    as new keys turn up, and the key columns in l_indexKeys are indexed 
+    once all hits are in.
+
+    The database is built in a temporary file that replaces <str_file>
+    on close().
+    """
+
+    l_indexKeys = [ 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'Modality', 'ModalitiesInStudy',
+                    'StudyDate', 'SeriesDate', 'PatientBirthDate']
+    l_reports   = ['series', 'study']
+
+    def __init__(self, str_file, **kwargs):
+        self.str_file       = str_file
+        self.str_tmpFile    = str_file + '.tmp'
+        self.d_columns      = {}
+        if os.path.exists(self.str_tmpFile):
+            os.remove(self.str_tmpFile)
+        self.db             = sqlite3.connect(self.str_tmpFile)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        # Both tables exist even without hits, so that a query of the 
+        # database finds no hits rather than no table
+        for report in self.l_reports:
+            self.db.execute('CREATE TABLE %s (row INTEGER PRIMARY KEY, hit TEXT)' % report)
+            self.d_columns[report]  = set()
+
+    @staticmethod
+    def name_quote(str_name):
+        return '"%s"' % str_name.replace('"', '""')
+
+    def row_add(self, report, row, d_entry):
+        """
+        Add the hit <d_entry>, at position <row>, to the <report> table.
+        """
+        d_hit           = d_entry.dict_get() if isinstance(d_entry, HitsRow) else d_entry
+        l_column        = ['row', 'hit']
+        l_value         = [row, json.dumps(d_hit)]
+        for key, cell in d_hit.items():
+            if key in ['row', 'hit']: continue
+            if key not in self.d_columns[report]:
+                self.db.execute('ALTER TABLE %s ADD COLUMN %s' % (report, self.name_quote(key)))
+                self.d_columns[report].add(key)
+            value       = cell.get('value') if isinstance(cell, dict) else cell
+            # Values are kept as text, as HitsSelector compares them
+            if isinstance(value, (dict, list)):
+                value   = json.dumps(value)
+            elif value is not None:
+                value   = '%s' % value
+            l_column.append(self.name_quote(key))
+            l_value.append(value)
+        self.db.execute('INSERT INTO %s (%s) VALUES (%s)' % 
+                            (report, ','.join(l_column), ','.join(['?'] * len(l_value))),
+                        l_value)
+
+    def close(self):
+        """
+        Index the key columns, and move the database in place.
+        """
+        try:
+            for report, s_column in self.d_columns.items():
+                for key in self.l_indexKeys:
+                    if key in s_column:
+                        self.db.execute('CREATE INDEX %s ON %s (%s)' % 
+                                (self.name_quote('%s_%s' % (report, key)), report, self.name_quote(key)))
+            self.db.commit()
+        except:
+            self.abort()
+            raise
+        self.db.close()
+        os.replace(self.str_tmpFile, self.str_file)
+
+    def abort(self):
+        """
+        Close the database and remove it, leaving any prior database in
+        place.
+        """
+        self.db.close()
+        if os.path.exists(self.str_tmpFile):
+            os.remove(self.str_tmpFile)
+
+class RetrieveJournal(object):
+    """
+    A journal of the state of each series of a retrieve, kept as a file
+    of JSON lines, one per state change:
+
+        {"series": <SeriesInstanceUID>, "state": <state>, "time": <time>, ...}
+
+    Each line is written with a single append (O_APPEND) write, so that
+    lines of concurrent writers do not interleave, and a run that is 
+    killed leaves at worst a partial last line, which is skipped when 
+    the journal is read back. The last state of a series wins.
+    """
+
+    l_state = ['initiated', 'received', 'pulled', 'previewed']
+
+    def __init__(self, str_file):
+        self.str_file   = str_file
+        self.d_series   = {}
+        self.lock       = threading.Lock()
+        if os.path.exists(self.str_file):
+            with open(self.str_file, 'rb') as f:
+                for str_line in f:
+                    try:
+                        d_record    = json.loads(str_line)
+                        self.d_series[d_record['series']]   = d_record
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        self.fd         = os.open(self.str_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # A partial last line, from a run that was killed, is ended first
+        size            = os.fstat(self.fd).st_size
+        if size:
+            with open(self.str_file, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n': os.write(self.fd, b'\n')
+
+    def record(self, str_seriesUID, str_state, **kwargs):
+        """
+        Append the <str_state> of <str_seriesUID>, with any <kwargs>.
+        """
+        d_record        = dict(kwargs, series = str_seriesUID, state = str_state, time = time.time())
+        str_line        = '%s\n' % json.dumps(d_record)
+        with self.lock:
+            os.write(self.fd, str_line.encode())
+            self.d_series[str_seriesUID]    = d_record
+
+    def state_get(self, str_seriesUID):
+        """
+        Return the last record of <str_seriesUID>, or an empty dictionary.
+        """
+        return self.d_series.get(str_seriesUID, {})
+
+    def close(self):
+        os.close(self.fd)
+
+class DICOMCache(object):
+    """
+    A DICOM cache, shared by retrieves across runs, keyed on the
+    SeriesInstanceUID and SOPInstanceUID of each file:
+
+        <cacheDir>/series/<SeriesInstanceUID>/<SOPInstanceUID>.dcm
+        <cacheDir>/series/<SeriesInstanceUID>/.manifest.json
+
+    The manifest of a series maps each SOPInstanceUID to the name of the
+    file as it was pulled, and is only written once all its files are in,
+    so a series is either fully cached or not at all. Its mtime is the 
+    time of the last use of the series, and once the cache grows over 
+    <maxBytes> (if not 0), the least recently used series are evicted.
+
+    Files are cloned into the cache (see file_clone()), so that they do
+    not share inodes with the pulled files, and are made read only. They
+    are materialized in an output dir as hardlinks (or reflinks, or
+    copies, see file_link()). Series that are pinned, by series_pin(),
+    are not evicted by this DICOMCache.
+
+    Readers take a shared lock on the cache, as do inserts while they
+    fill their '<cacheDir>/tmp' dir. Evictions (and the move of an insert
+    into place) take an exclusive lock. Each insert also holds a lock on
+    its own tmp dir until it is done, so that evictions only remove the
+    tmp dirs of inserts that were killed.
+    """
+
+    str_manifest    = '.manifest.json'
+
+    def __init__(self, str_cacheDir, **kwargs):
+        self.str_cacheDir   = str_cacheDir
+        self.str_seriesDir  = os.path.join(str_cacheDir, 'series')
+        self.maxBytes       = 0
+        for k, v in kwargs.items():
+            if k == 'maxBytes':     self.maxBytes   = v
+        os.makedirs(self.str_seriesDir, exist_ok = True)
+        self.str_tmpDir     = os.path.join(str_cacheDir, 'tmp')
+        self.str_lockFile   = os.path.join(str_cacheDir, '.lock')
+        self.s_pinned       = set()
+        self.lock_pinned    = threading.Lock()
+
+    def series_pin(self, str_seriesUID):
+        """
+        Keep <str_seriesUID> from eviction, until series_unpin().
+        """
+        with self.lock_pinned:
+            self.s_pinned.add(str_seriesUID)
+
+    def series_unpin(self, str_seriesUID):
+        with self.lock_pinned:
+            self.s_pinned.discard(str_seriesUID)
+
+    def lock(self, b_exclusive):
+        """
+        Return an open lock file, locked (shared, or <b_exclusive>) on
+        the cache. Closing it releases the lock.
+        """
+        f       = open(self.str_lockFile, 'a')
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if b_exclusive else fcntl.LOCK_SH)
+        return f
+
+    def tmpDir_lock(self, str_tmpDir, b_wait = True):
+        """
+        Return an open descriptor of <str_tmpDir>, locked exclusively, or
+        None if it is locked by a live insert (and not <b_wait>). Closing
+        the descriptor, or the death of its process, releases the lock.
+        """
+        fd      = os.open(str_tmpDir, os.O_RDONLY)
+        if fcntl:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if b_wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                os.close(fd)
+                return None
+        return fd
+
+    def seriesDir_get(self, str_seriesUID):
+        return os.path.join(self.str_seriesDir, str_seriesUID.replace(os.sep, '_'))
+
+    def series_lookup(self, str_seriesUID):
+        """
+        Return the manifest of a (fully) cached series, or None.
+        """
+        try:
+            with open(os.path.join(self.seriesDir_get(str_seriesUID), self.str_manifest)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def series_materialize(self, str_seriesUID, str_path):
+        """
+        Materialize a cached series in <str_path>, with its files under
+        their pulled names. Return a dictionary with the 'status', the 
+        number of 'files' and 'bytes', and the link 'methods' used.
+        """
+        d_ret       = {'status': False, 'files': 0, 'bytes': 0, 'methods': {}}
+        with self.lock(False):
+            d_manifest  = self.series_lookup(str_seriesUID)
+            if not d_manifest:
+                return d_ret
+            str_dir     = self.seriesDir_get(str_seriesUID)
+            os.makedirs(str_path, exist_ok = True)
+            for str_SOPUID, str_name in d_manifest['files'].items():
+                str_target  = os.path.join(str_path, str_name)
+                if os.path.exists(str_target):
+                    os.remove(str_target)
+                str_method  = file_link(os.path.join(str_dir, str_SOPUID + '.dcm'), str_target)
+                d_ret['methods'][str_method]    = d_ret['methods'].get(str_method, 0) + 1
+                d_ret['files'] += 1
+            d_ret['bytes']  = d_manifest['bytes']
+            os.utime(os.path.join(str_dir, self.str_manifest))
+        d_ret['status']     = True
+        return d_ret
+
+    def series_insert(self, str_seriesUID, l_file):
+        """
+        Add the pulled DICOM files <l_file> of a series to the cache (if
+        it is not cached yet), then evict down to self.maxBytes. The
+        series itself is not evicted, even if it alone is over maxBytes.
+        """
+        if self.series_lookup(str_seriesUID):
+            return
+        str_tmpDir  = os.path.join(self.str_tmpDir, '%s.%d.%d' % 
+                                    (str_seriesUID, os.getpid(), threading.get_ident()))
+        d_manifest  = {'series': str_seriesUID, 'files': {}, 'bytes': 0}
+        fd_tmp      = None
+        try:
+            with self.lock(False):
+                os.makedirs(str_tmpDir)
+                fd_tmp  = self.tmpDir_lock(str_tmpDir)
+                for str_file in l_file:
+                    str_SOPUID  = dicomSOPInstanceUID_read(str_file).replace(os.sep, '_')
+                    str_cached  = os.path.join(str_tmpDir, str_SOPUID + '.dcm')
+                    if os.path.exists(str_cached):
+                        continue
+                    file_clone(str_file, str_cached)
+                    os.chmod(str_cached, 0o444)
+                    d_manifest['files'][str_SOPUID] = os.path.basename(str_file)
+                    d_manifest['bytes']            += os.path.getsize(str_cached)
+                with open(os.path.join(str_tmpDir, self.str_manifest), 'w') as f:
+                    json.dump(d_manifest, f)
+            with self.lock(True):
+                str_dir     = self.seriesDir_get(str_seriesUID)
+                if not os.path.exists(str_dir):
+                    os.rename(str_tmpDir, str_dir)
+                self.evict(keep = [str_seriesUID])
+        finally:
+            if os.path.exists(str_tmpDir):
+                shutil.rmtree(str_tmpDir, ignore_errors = True)
+            if fd_tmp is not None:
+                os.close(fd_tmp)
+
+    def evict(self, **kwargs):
+        """
+        Remove the least recently used series, other than those pinned
+        or in <keep>, until the cache holds at most self.maxBytes, and
+        remove the tmp dirs of killed inserts. Called with the exclusive
+        lock held.
+        """
+        l_keep      = []
+        for k, v in kwargs.items():
+            if k == 'keep':     l_keep      = v
+
+        # Without file locks, a tmp dir may be that of a live insert
+        if fcntl and os.path.isdir(self.str_tmpDir):
+            for entry in os.scandir(self.str_tmpDir):
+                try:
+                    fd_tmp  = self.tmpDir_lock(entry.path, b_wait = False)
+                except OSError:
+                    continue
+                if fd_tmp is None:
+                    continue
+                try:
+                    shutil.rmtree(entry.path, ignore_errors = True)
+                finally:
+                    os.close(fd_tmp)
+        if self.maxBytes <= 0:
+            return
+        with self.lock_pinned:
+            s_keep  = set([self.seriesDir_get(str_seriesUID)
+                            for str_seriesUID in list(self.s_pinned) + list(l_keep)])
+        l_series    = []
+        total       = 0
+        for entry in os.scandir(self.str_seriesDir):
+            try:
+                str_manifest    = os.path.join(entry.path, self.str_manifest)
+                with open(str_manifest) as f:
+                    size        = json.load(f)['bytes']
+                l_series.append((os.path.getmtime(str_manifest), size, entry.path))
+                total          += size
+            except (OSError, ValueError, KeyError):
+                continue
+        for mtime, size, str_dir in sorted(l_series):
+            if total <= self.maxBytes:
+                break
+            if str_dir in s_keep:
+                continue
+            shutil.rmtree(str_dir, ignore_errors = True)
+            total  -= size
+
+class ServiceUnreachable(ConnectionError):
+    """
+    Raised by ServiceConnectionPool.post() when no connection to the 
+    service could be made, or the request could not be written to it,
+    i.e. the message was certainly not received in full.
+    """
+    pass
+
+class ServiceConnectionPool(object):
+    """
+    A thread-safe pool of persistent HTTP/1.1 connections to a service
+    such as 'pfdcm'. Messages are POSTed in the same form as 'pfurl' 
+    uses, i.e. JSON wrapped in a <jsonwrapper> key.
+    """
+
+    def __init__(self, str_http, **kwargs):
+        self.str_protocol           = 'http'
+        self.str_ip                 = ''
+        self.str_port               = ''
+        self.str_URL                = '/'
+        self.str_jsonwrapper        = 'payload'
+        self.maxIdle                = 8
+        self.timeout                = 300
+
+        for k, v in kwargs.items():
+            if k == 'jsonwrapper':  self.str_jsonwrapper    = v
+            if k == 'maxIdle':      self.maxIdle            = v
+            if k == 'timeout':      self.timeout            = v
+
+        self.httpStr_parse(str_http)
+        self.q_idle                 = queue.LifoQueue(maxsize = self.maxIdle)
+        self.lock                   = threading.Lock()
+        self.connectionsOpened      = 0
+
+    def httpStr_parse(self, str_http):
+        """
+        Split an [<protocol>://]<IP>[:<port>][/<URL>] spec, as 'pfurl' does.
+        """
+        if '://' in str_http:
+            self.str_protocol, str_http = str_http.split('://', 1)
+        l_pathSplit                 = str_http.split('/')
+        self.str_URL                = '/' + '/'.join(l_pathSplit[1:])
+        l_IPport                    = l_pathSplit[0].split(':')
+        self.str_ip                 = l_IPport[0]
+        if len(l_IPport) > 1:
+            self.str_port           = l_IPport[1]
+
+    def connection_get(self):
+        """
+        Return a tuple of (connection, b_reused) -- an idle connection 
+        from the pool if there is one, else a new connection. Idle
+        connections that the server has since closed (their socket is
+        readable, at EOF) are dropped.
+        """
+        while True:
+            try:
+                conn    = self.q_idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if conn.sock and not select.select([conn.sock], [], [], 0)[0]:
+                    return conn, True
+            except (OSError, ValueError):
+                pass
+            conn.close()
+        if self.str_protocol == 'https':
+            conn    = http.client.HTTPSConnection(  self.str_ip,
+                                                    self.str_port or None,
+                                                    timeout = self.timeout)
+        else:
+            conn    = http.client.HTTPConnection(   self.str_ip,
+                                                    self.str_port or None,
+                                                    timeout = self.timeout)
+        with self.lock:
+            self.connectionsOpened += 1
+        return conn, False
+
+    def connection_release(self, conn):
+        """
+        Return a connection to the pool, or close it if the pool is full.
+        """
+        try:
+            self.q_idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def post(self, d_msg):
+        """
+        POST <d_msg> to the service and return the (bytes) response body.
+        Raise ServiceUnreachable if the service could not be connected to,
+        or the request could not be written.
+
+        A request that could not be written to a reused connection (that
+        the server has meanwhile closed) is retried on a fresh connection.
+        Once the request is written, it may have been acted on, so a
+        failure to read the response is raised and never retried.
+        """
+        # As bytes, the body goes out in the same packet as the headers
+        str_body        = json.dumps({self.str_jsonwrapper: d_msg}).encode()
+        d_headers       = {
+            'Content-Type': 'application/json',
+            'Mode':         'control'
+        }
+        while True:
+            conn, b_reused  = self.connection_get()
+            if not b_reused:
+                try:
+                    conn.connect()
+                except OSError as e:
+                    conn.close()
+                    raise ServiceUnreachable('%s://%s:%s: %s' % 
+                                (self.str_protocol, self.str_ip, self.str_port, e))
+            try:
+                conn.request('POST', self.str_URL, body = str_body, headers = d_headers)
+            except OSError as e:
+                conn.close()
+                if b_reused: continue
+                raise ServiceUnreachable('%s://%s:%s: %s' %
+                            (self.str_protocol, self.str_ip, self.str_port, e))
+            try:
+                response    = conn.getresponse()
+                str_response= response.read()
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self.connection_release(conn)
+            if response.status >= 400:
+                raise http.client.HTTPException('HTTP %d %s' % 
+                                                (response.status, response.reason))
+            return str_response
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        while True:
+            try:
+                self.q_idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+def dcm2jpg_convert(str_inputDICOMfile, str_outputJPGfile):
+    """
+    Convert a single DICOM file to jpg. Run in a preview worker process.
+    """
+    try:
+        response    = subprocess.run(   ['/usr/bin/dcmj2pnm', '+oj', '+Wh', '15', '+Fa',
+                                         str_inputDICOMfile, str_outputJPGfile],
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.STDOUT
+                                    )
+    except OSError:
+        return 127
+    return response.returncode
+
+def jpg_resize(lstr_jpgFile):
+    """
+    Resize a batch of jpg files to 96x96 thumbnails with a single 'mogrify'
+    call. Run in a preview worker process.
+    """
+    try:
+        response    = subprocess.run(   ['/usr/bin/mogrify', '-resize', '96x96', '-background', 'none',
+                                         '-gravity', 'center', '-extent', '96x96'] + lstr_jpgFile,
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.STDOUT
+                                    )
+    except OSError:
+        return 127
+    return response.returncode
+
+def dicomThumbnail_render(str_inputDICOMfile, str_thumbnailFile, size = 96, ignorePercent = 15):
+    """
+    Render a single DICOM file into a <size>x<size> jpg thumbnail without
+    any intermediate full resolution image on disk. Run in a preview
+    worker process.
+
+    The pixel data is decoded by pydicom, block averaged down to about
+    the thumbnail size and windowed by NumPy -- ignoring <ignorePercent>
+    of the histogram, as 'dcmj2pnm +Wh' does -- and finally fit and
+    centered on the thumbnail by Pillow.
+
+    Return a (mode, bytes) tuple of the raw thumbnail, or None if the
+    file cannot be decoded in-process (e.g. due to its transfer syntax).
+    """
+    try:
+        ds          = pydicom.dcmread(str_inputDICOMfile)
+        pixels      = ds.pixel_array
+    except Exception:
+        return None
+
+    b_color         = getattr(ds, 'SamplesPerPixel', 1) > 1
+    if int(getattr(ds, 'NumberOfFrames', 1) or 1) > 1:
+        pixels      = pixels[0]
+    if pixels.ndim < 2:
+        return None
+
+    # Downsample by block averaging to no less than the thumbnail size
+    rows, cols      = pixels.shape[0], pixels.shape[1]
+    factor          = max(1, min(rows, cols) // size)
+    rows, cols      = rows // factor * factor, cols // factor * factor
+    pixels          = pixels[:rows, :cols].astype(numpy.float32)
+    if factor > 1:
+        pixels      = pixels.reshape(   (rows // factor, factor, cols // factor, factor) + 
+                                        pixels.shape[2:]).mean(axis = (1, 3))
+
+    if b_color:
+        pixels      = numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+        image       = Image.fromarray(pixels, 'RGB')
+    else:
+        low, high   = numpy.percentile(pixels, [ignorePercent / 2.0, 100 - ignorePercent / 2.0])
+        if high <= low:
+            low, high   = pixels.min(), pixels.max() + 1
+        pixels      = (pixels - low) * (255.0 / (high - low))
+        pixels      = numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+        if getattr(ds, 'PhotometricInterpretation', '') == 'MONOCHROME1':
+            pixels  = 255 - pixels
+        image       = Image.fromarray(pixels, 'L')
+
+    # Fit (up or down) into the thumbnail, as 'mogrify -resize' does
+    scale           = float(size) / max(image.width, image.height)
+    image           = image.resize( (max(1, round(image.width  * scale)),
+                                     max(1, round(image.height * scale))), Image.LANCZOS)
+    thumbnail       = Image.new(image.mode, (size, size))
+    thumbnail.paste(image, ((size - image.width) // 2, (size - image.height) // 2))
+    thumbnail.save(str_thumbnailFile, 'JPEG')
+    return (thumbnail.mode, thumbnail.tobytes())
+
+def dicomInstanceNumber_read(str_inputDICOMfile):
+    """
+    Return the InstanceNumber of a DICOM file from a header-only read (by
+    pydicom or, without it, dcmtk's 'dcmdump'), or None if this cannot be
+    read. Run in a preview worker process.
+    """
+    try:
+        if pydicom:
+            ds  = pydicom.dcmread(  str_inputDICOMfile, 
+                                    stop_before_pixels  = True,
+                                    specific_tags       = ['InstanceNumber'])
+            return int(ds.InstanceNumber)
+        response    = subprocess.run(   ['/usr/bin/dcmdump', '+P', 'InstanceNumber', 
+                                         str_inputDICOMfile],
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.DEVNULL
+                                    )
+        return int(re.search(r'\[\s*([-+]?\d+)\s*\]', response.stdout.decode()).group(1))
+    except Exception:
+        return None
+
+def dicomSOPInstanceUID_read(str_inputDICOMfile):
+    """
+    Return the SOPInstanceUID of a DICOM file from a header-only read or,
+    failing that, from a '<InstanceNumber>-<SOPInstanceUID>.dcm' file name.
+    """
+    if pydicom:
+        try:
+            ds  = pydicom.dcmread(  str_inputDICOMfile,
+                                    stop_before_pixels  = True,
+                                    specific_tags       = ['SOPInstanceUID'])
+            return str(ds.SOPInstanceUID)
+        except Exception:
+            pass
+    str_name    = os.path.splitext(os.path.basename(str_inputDICOMfile))[0]
+    return str_name.split('-', 1)[-1]
+
+def file_link(str_source, str_target):
+    """
+    Make <str_target> a hardlink to <str_source> or, across filesystems,
+    a clone of it (see file_clone()). Return the method used.
+    """
+    try:
+        os.link(str_source, str_target)
+        return 'hardlink'
+    except OSError:
+        pass
+    return file_clone(str_source, str_target)
+
+def file_clone(str_source, str_target):
+    """
+    Make <str_target> a reflink of <str_source> (a copy on write clone,
+    where the filesystem supports it) or, failing that, a plain copy.
+    Unlike a hardlink, <str_target> has its own inode, and mode. Return
+    the method used.
+    """
+    if fcntl:
+        FICLONE     = 0x40049409
+        try:
+            with open(str_source, 'rb') as fsrc, open(str_target, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    file_copy(str_source, str_target)
+    return 'copy'
+
+def file_copy(str_source, str_target):
+    """
+    Copy <str_source> to <str_target> in the kernel, with copy_file_range()
+    or, where that is not supported, sendfile(), and failing both with a 
+    plain read/write copy. Return the number of bytes copied.
+    """
+    with open(str_source, 'rb') as fsrc, open(str_target, 'wb') as fdst:
+        size        = os.fstat(fsrc.fileno()).st_size
+        copied      = 0
+        try:
+            while copied < size:
+                n   = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 
+                                         size - copied, copied, copied)
+                if not n: break
+                copied += n
+        except (AttributeError, OSError):
+            try:
+                os.lseek(fdst.fileno(), copied, os.SEEK_SET)
+                while copied < size:
+                    n   = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                    if not n: break
+                    copied += n
+            except (AttributeError, OSError):
+                fsrc.seek(copied)
+                fdst.seek(copied)
+                shutil.copyfileobj(fsrc, fdst)
+                copied  = fdst.tell()
+    return copied
+
 class PacsRetrieveApp(ChrisApp):
     AUTHORS         = 'FNNDSC (dev@babyMRI.org)'
     SELFPATH        = os.path.dirname(os.path.abspath(__file__))
@@ -247,12 +1765,57 @@ class PacsRetrieveApp(ChrisApp):
         # Service and payload vars
         self.str_pfdcm              = ''
         self.str_msg                = ''
+        self.str_serviceTransport   = 'pfurl'
+        self.servicePool            = None
+        self.lock_servicePool       = threading.Lock()
+        # actions that pfurl processes on this side, from/to a path
+        self.s_pathActions          = {'pullPath', 'pushPath'}
+        # JSON backend, 'json' or 'orjson'
+        self.str_jsonBackend        = 'json'
+        # bulk message control, and per-action bulk support by the service
+        # -- path actions are handled by pfurl itself, which knows no bulk
+        self.b_bulkMessages         = False
+        self.d_bulkSupported        = {str_action: False for str_action in self.s_pathActions}
         # list holder for commands
         self.l_dmsg                 = []
         # a single retrieve command
         self.d_msg                  = {}
         # list holder for successful retrieves
         self.l_retrieveOK           = []
+        # list holder for the calls of retrieves that failed to initiate
+        self.l_retrieveFailed       = []
+        # max number of concurrent retrieve initiations
+        self.maxConcurrentRetrieves = 1
+        # max number of concurrent retrieve status checks
+        self.maxConcurrentStatusChecks  = 1
+        # number of series that can be pulled/previewed at the same time
+        self.pipelineWorkers        = 4
+        # preview worker processes, shared by all series
+        self.previewWorkers         = 1
+        self.previewPool            = None
+        self.lock_previewPool       = threading.Lock()
+        # max number of files per 'mogrify' call
+        self.mogrifyBatchMax        = 256
+        # preview engine, 'native' or 'dcmtk'
+        self.str_previewEngine      = 'dcmtk'
+        self.previewSize            = 96
+        # number of slices to sample per preview, 0 for all
+        self.previewSamples         = 0
+        # preview layout, 'strip' or 'mosaic', and its limits
+        self.str_previewLayout      = 'strip'
+        self.previewColumns         = 8
+        self.previewMaxTiles        = 256
+        # per jpg dir record of thumbnail sources and preview inputs
+        self.str_previewManifest    = '.manifest.json'
+        # retrieve status polling schedule
+        self.pollIntervalMin        = 0.5
+        self.pollIntervalMax        = 30.0
+        self.pollJitter             = 0.2
+        self.instancesPerSecond     = 10.0
+        self.retrieveTimeout        = 3600.0
+        # hits table entries of the series to retrieve, keyed on SeriesInstanceUID
+        self.seriesHits             = None
+        self.d_seriesHits           = {}
 
         # Alternate, simplified CLI flags
         self.str_patientID          = ''
@@ -269,8 +1832,25 @@ class PacsRetrieveApp(ChrisApp):
         self.b_pfurlQuiet           = False
         self.b_serviceCallQuiet     = False
 
-        # Prior hits JSON dictionary
+        # Prior hits JSON dictionary, and the series hits read from it
         self.d_query                = {}
+        self.d_queryRow             = {}
+        # Prior hits database, and the series selection expression
+        self.str_priorHitsDB        = ''
+        self.str_select             = ''
+        # study level retrieves, and the number of series per study in the prior hits
+        self.b_studyRetrieve        = False
+        self.d_studySeries          = {}
+        # retrieve order, and the budget of instances in flight (0 for none)
+        self.str_retrieveOrder      = 'index'
+        self.maxInstancesInFlight   = 0
+        # retrieve journal in the output dir, and its RetrieveJournal
+        self.str_journal            = ''
+        self.journal                = None
+        # shared DICOM cache dir (and its DICOMCache) and size limit
+        self.str_cacheDir           = ''
+        self.cache                  = None
+        self.cacheMaxGB             = 0.0
 
         # Summary report
         self.b_summaryReport        = False
@@ -279,9 +1859,28 @@ class PacsRetrieveApp(ChrisApp):
         self.str_studySummaryKeys   = ''
         self.str_studySummaryFile   = ''
         self.l_summaryKeys          = []
+        self.str_summaryFormat      = 'text'
+        # PatientAge per (PatientBirthDate, StudyDate)
+        self.d_patientAge           = {}
 
         # Result report
         self.str_resultFile         = ''
+
+        # Pull dir template, the DICOM tags it references, and a per
+        # series cache of DICOM tags returned by the service
+        self.pullDirTemplate_re     = re.compile(r'%([A-Za-z][A-Za-z0-9]*)')
+        self.str_pullDirTemplate    = ''
+        self.l_pullDirTemplateTags  = None
+        self.d_DICOMtags            = {}
+        self.lock_DICOMtags         = threading.Lock()
+        # pull mode, 'service' or 'local', and for 'local' the log dir of
+        # the service's smdb, its (lazily opened) smdb, and the copy threads
+        self.str_pullMode           = 'service'
+        self.str_smdbDir            = '/home/dicom/log'
+        self.smdb                   = None
+        self.lock_smdb              = threading.Lock()
+        self.pullWorkers            = 8
+        self.pullPool               = None
        
     def define_parameters(self):
         """
@@ -321,6 +1920,133 @@ class PacsRetrieveApp(ChrisApp):
             default     = '',
             optional    = True,
             help        = 'A JSON formatted file returned by a prior call to pacsquery.')
+        self.add_argument(
+            '--priorHitsDB',
+            dest        = 'str_priorHitsDB',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'An SQLite database of hits saved by a prior call to pacsquery (see --hitsDB).')
+        self.add_argument(
+            '--select',
+            dest        = 'str_select',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'Retrieve the series in the prior hits that match this expression.')
+        self.add_argument(
+            '--studyRetrieve',
+            dest        = 'b_studyRetrieve',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'Retrieve studies of which all series are selected with a single study level message.')
+        self.add_argument(
+            '--retrieveOrder',
+            dest        = 'str_retrieveOrder',
+            type        = str,
+            default     = 'index',
+            optional    = True,
+            help        = 'The order of retrieves: "index", "smallest", "largest" or "roundrobin" (by study).')
+        self.add_argument(
+            '--maxInstancesInFlight',
+            dest        = 'maxInstancesInFlight',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'The maximum number of instances of retrieves in flight at a time (0 for no limit).')
+        self.add_argument(
+            '--journal',
+            dest        = 'str_journal',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'A journal (in outputdir) of the state of each series, to resume an interrupted retrieve from.')
+        self.add_argument(
+            '--cacheDir',
+            dest        = 'str_cacheDir',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'A DICOM cache directory shared by retrieves across runs.')
+        self.add_argument(
+            '--cacheMaxGB',
+            dest        = 'cacheMaxGB',
+            type        = float,
+            default     = 0.0,
+            optional    = True,
+            help        = 'Evict least recently used series from the cache beyond this size (0 for no limit).')
+        self.add_argument(
+            '--pullMode',
+            dest        = 'str_pullMode',
+            type        = str,
+            default     = 'service',
+            optional    = True,
+            help        = "How series are pulled to the output dir, 'service' or 'local'.")
+        self.add_argument(
+            '--smdbDir',
+            dest        = 'str_smdbDir',
+            type        = str,
+            default     = '/home/dicom/log',
+            optional    = True,
+            help        = "In 'local' pull mode, the log dir of the service's smdb.")
+        self.add_argument(
+            '--pullWorkers',
+            dest        = 'pullWorkers',
+            type        = int,
+            default     = 8,
+            optional    = True,
+            help        = "In 'local' pull mode, the number of threads that pull files.")
+        self.add_argument(
+            '--maxConcurrentRetrieves',
+            dest        = 'maxConcurrentRetrieves',
+            type        = int,
+            default     = 1,
+            optional    = True,
+            help        = 'The maximum number of concurrent retrieve initiations.')
+        self.add_argument(
+            '--maxConcurrentStatusChecks',
+            dest        = 'maxConcurrentStatusChecks',
+            type        = int,
+            default     = 1,
+            optional    = True,
+            help        = 'The maximum number of concurrent retrieve status checks per poll cycle.')
+        self.add_argument(
+            '--pipelineWorkers',
+            dest        = 'pipelineWorkers',
+            type        = int,
+            default     = 4,
+            optional    = True,
+            help        = 'The number of series that can be pulled and previewed concurrently.')
+        self.add_argument(
+            '--pollIntervalMin',
+            dest        = 'pollIntervalMin',
+            type        = float,
+            default     = 0.5,
+            optional    = True,
+            help        = 'The shortest wait (in seconds) between status checks on a pending series.')
+        self.add_argument(
+            '--pollIntervalMax',
+            dest        = 'pollIntervalMax',
+            type        = float,
+            default     = 30.0,
+            optional    = True,
+            help        = 'The longest wait (in seconds) between status checks on a pending series.')
+        self.add_argument(
+            '--instancesPerSecond',
+            dest        = 'instancesPerSecond',
+            type        = float,
+            default     = 10.0,
+            optional    = True,
+            help        = 'The assumed PACS delivery rate, used to estimate series completion times.')
+        self.add_argument(
+            '--retrieveTimeout',
+            dest        = 'retrieveTimeout',
+            type        = float,
+            default     = 3600.0,
+            optional    = True,
+            help        = 'Stop waiting on pending retrieves after this many seconds (0 waits forever).')
         self.add_argument(
             '--PatientID',
             dest        = 'str_patientID',
@@ -370,6 +2096,13 @@ class PacsRetrieveApp(ChrisApp):
             default     = '',
             optional    = True,
             help        = 'If specified, save (overwrite) a study summary report to passed file (in outputdir).')
+        self.add_argument(
+            '--summaryFormat',
+            dest        = 'str_summaryFormat',
+            type        = str,
+            default     = 'text',
+            optional    = True,
+            help        = 'The format of the summary reports: "text", "tsv", "csv" or (if pyarrow is installed) "parquet".')
         self.add_argument(
             '--numberOfHitsFile',
             dest        = 'str_numberOfHitsFile',
@@ -384,6 +2117,13 @@ class PacsRetrieveApp(ChrisApp):
             default     = '',
             optional    = True,
             help        = 'If specified, save (overwrite) all the hits to the passed file (in outputdir).')
+        self.add_argument(
+            '--hitsDB',
+            dest        = 'str_hitsDB',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save (overwrite) all the hits to an SQLite database (in outputdir).')
         self.add_argument(
             '--man',
             dest        = 'str_man',
@@ -398,6 +2138,28 @@ class PacsRetrieveApp(ChrisApp):
             default     = 'retrieve',
             optional    = True,
             help        = 'The action to perform. Default is "retrieve".')
+        self.add_argument(
+            '--serviceTransport',
+            dest        = 'str_serviceTransport',
+            type        = str,
+            default     = 'pfurl',
+            optional    = True,
+            help        = 'How to message the service: "pooled" keep-alive connections or "pfurl".')
+        self.add_argument(
+            '--jsonBackend',
+            dest        = 'str_jsonBackend',
+            type        = str,
+            default     = 'json',
+            optional    = True,
+            help        = 'The JSON backend: "json" or (if installed) the faster "orjson".')
+        self.add_argument(
+            '--bulkMessages',
+            dest        = 'b_bulkMessages',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'Batch per-series messages into single bulk messages, if the service supports it.'),
         self.add_argument(
             '--pfurlQuiet',
             dest        = 'b_pfurlQuiet',
@@ -422,6 +2184,48 @@ class PacsRetrieveApp(ChrisApp):
             action      = 'store_true',
             optional    = True,
             help        = 'Generate a local jpg preview of received DICOM data.'),
+        self.add_argument(
+            '--previewWorkers',
+            dest        = 'previewWorkers',
+            type        = int,
+            default     = 1,
+            optional    = True,
+            help        = 'The number of worker processes for jpg preview generation (0 for one per CPU).')
+        self.add_argument(
+            '--previewEngine',
+            dest        = 'str_previewEngine',
+            type        = str,
+            default     = 'dcmtk',
+            optional    = True,
+            help        = 'The jpg preview engine: "native" (pydicom/NumPy/Pillow) or "dcmtk" (dcmtk/ImageMagick).')
+        self.add_argument(
+            '--previewSamples',
+            dest        = 'previewSamples',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'If non-zero, preview only this many representative slices per series.')
+        self.add_argument(
+            '--previewLayout',
+            dest        = 'str_previewLayout',
+            type        = str,
+            default     = 'strip',
+            optional    = True,
+            help        = 'The preview layout: a vertical "strip" or a "mosaic" grid.')
+        self.add_argument(
+            '--previewColumns',
+            dest        = 'previewColumns',
+            type        = int,
+            default     = 8,
+            optional    = True,
+            help        = 'The number of columns in a "mosaic" preview.')
+        self.add_argument(
+            '--previewMaxTiles',
+            dest        = 'previewMaxTiles',
+            type        = int,
+            default     = 256,
+            optional    = True,
+            help        = 'The maximum number of tiles in a preview (0 for no limit).')
         self.add_argument(
             '--version',
             dest        = 'b_version',
@@ -437,12 +2241,11 @@ class PacsRetrieveApp(ChrisApp):
         """
         return self.pp.pformat(adict).strip()
 
-    def service_call(self, *args, **kwargs):
-
-        d_msg   = {}
-        for k, v in kwargs.items():
-            if k == 'msg':  d_msg   = v
-
+    def serviceCall_pfurl(self, d_msg):
+        """
+        Send <d_msg> to the service with a new 'pfurl' object, and return 
+        the response string.
+        """
         serviceCall = pfurl.Pfurl(
             msg                     = json.dumps(d_msg),
             http                    = self.str_pfdcm,
@@ -454,14 +2257,211 @@ class PacsRetrieveApp(ChrisApp):
             debugFile               = self.str_debugFile,
             useDebug                = self.b_useDebug
         )
-        
+        return serviceCall()
+
+    def serviceCall_pooled(self, d_msg):
+        """
+        Send <d_msg> to the service over the pool of persistent connections,
+        and return the (bytes) response body.
+        """
+        with self.lock_servicePool:
+            if not self.servicePool:
+                self.servicePool    = ServiceConnectionPool(
+                                        self.str_pfdcm,
+                                        jsonwrapper = 'payload',
+                                        maxIdle     = max(  8,
+                                                            self.maxConcurrentRetrieves,
+                                                            self.maxConcurrentStatusChecks)
+                                    )
+        return self.servicePool.post(d_msg)
+
+    def jsonBackend_get(self):
+        """
+        Return the JSON backend to use, falling back to 'json' if 
+        'orjson' was asked for but is not installed.
+        """
+        if self.str_jsonBackend == 'orjson' and not orjson:
+            self.dp.qprint('orjson is not installed, using the json backend instead.',
+                            comms = 'error')
+            self.str_jsonBackend    = 'json'
+        return self.str_jsonBackend
+
+    def json_loads(self, str_JSON):
+        """
+        Parse the (string or bytes) <str_JSON> with the JSON backend.
+        """
+        if self.jsonBackend_get() == 'orjson':
+            return orjson.loads(str_JSON)
+        return json.loads(str_JSON)
+
+    def service_call(self, *args, **kwargs):
+        """
+        Send the <msg> to the service and return its response. With the
+        pooled transport, a message that could not be sent is sent with
+        pfurl instead or, if not <fallback>, ServiceUnreachable is raised.
+        """
+
+        d_msg       = {}
+        b_fallback  = True
+        for k, v in kwargs.items():
+            if k == 'msg':      d_msg       = v
+            if k == 'fallback': b_fallback  = v
+
         if not self.b_serviceCallQuiet:
             self.dp.qprint('Sending d_msg ==>\n %s' % self.df_print(d_msg), comms='tx')
-        d_response      = json.loads(serviceCall())
+
+        # Path type actions are processed on this side by pfurl itself
+        str_action      = d_msg.get('action', '') if isinstance(d_msg, dict) else ''
+        if self.str_serviceTransport == 'pooled' and str_action not in self.s_pathActions:
+            try:
+                str_response    = self.serviceCall_pooled(d_msg)
+            except ServiceUnreachable as e:
+                # Only a message that was certainly not sent is safe to send
+                # again -- a 'retrieve' must not be repeated
+                if not b_fallback:
+                    raise
+                self.dp.qprint('Pooled service call failed (%s), falling back to pfurl...' % e,
+                                comms = 'error')
+                str_response    = self.serviceCall_pfurl(d_msg)
+        else:
+            str_response        = self.serviceCall_pfurl(d_msg)
+
+        d_response      = self.json_loads(str_response)
         if not self.b_serviceCallQuiet:
             self.dp.qprint('Received d_response <==\n %s' % self.df_print(d_response), comms='rx')
         return d_response
 
+    def serviceCall_fanOut(self, al_msg, **kwargs):
+        """
+        Send each message in <al_msg> to the service, using at most
+        <workers> concurrent calls, and return the list of responses
+        in the same order as <al_msg>.
+
+        A call that fails does not abort the batch -- its slot in the
+        returned list holds a response with a False 'status' and the
+        error string.
+        """
+        workers     = 1
+        str_note    = ''
+        l_ret       = []
+
+        for k, v in kwargs.items():
+            if k == 'workers':  workers     = v
+            if k == 'note':     str_note    = v
+
+        def call(d_msg):
+            if len(str_note): self.dp.qprint(str_note)
+            try:
+                return self.service_call(msg = d_msg)
+            except Exception as e:
+                return {
+                    'status':           False,
+                    'serviceCallError': '%s' % e,
+                    'msg':              d_msg
+                }
+
+        if workers <= 1 or len(al_msg) <= 1:
+            l_ret   = [call(d_msg) for d_msg in al_msg]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers = min(workers, len(al_msg))) as executor:
+                l_ret   = list(executor.map(call, al_msg))
+
+        for d_msg, d_ret in zip(al_msg, l_ret):
+            if isinstance(d_ret, dict) and 'serviceCallError' in d_ret:
+                self.dp.qprint('Service call failed for %s: %s' %
+                                (json.dumps(d_msg.get('meta', {}).get('on', {})),
+                                d_ret['serviceCallError']),
+                                comms = 'error')
+        return l_ret
+
+    def serviceCall_bulk(self, al_msg):
+        """
+        Try to send a list of messages that share the same 'action' as a 
+        single bulk message, i.e.
+
+            {'action': <action>, 'meta': {'bulk': [<meta0>, <meta1>, ...]}}
+
+        Return a dictionary with a True 'status' and the list of per-message
+        responses in 'bulk' if the service answered with a 'bulk' list of 
+        the correct length, else with a False 'status'.
+
+        The bulk message is only known not to have been acted on if the
+        service could not be reached, or rejected it as a whole (a False
+        'status' and no 'bulk' list, as from a service that does not know
+        the bulk form) -- then 'supported' is False, and the messages can
+        be sent one by one. In any other failure, as the messages may have
+        been acted on, 'bulk' holds a failed response for each.
+        """
+        d_ret       = {
+            'status':       False,
+            'supported':    True,
+            'bulk':         []
+        }
+        d_bulkMsg   = {
+            'action':   al_msg[0]['action'],
+            'meta': {
+                'bulk': [d_msg['meta'] for d_msg in al_msg]
+            }
+        }
+        try:
+            d_response  = self.service_call(msg = d_bulkMsg, fallback = False)
+        except ServiceUnreachable as e:
+            self.dp.qprint('Bulk service call not sent: %s' % e, comms = 'error')
+            d_ret['supported']  = False
+            return d_ret
+        except Exception as e:
+            d_response  = None
+            str_error   = 'bulk service call failed: %s' % e
+        if isinstance(d_response, dict)                 and \
+           isinstance(d_response.get('bulk'), list)     and \
+           len(d_response['bulk']) == len(al_msg):
+            d_ret['status'] = True
+            d_ret['bulk']   = d_response['bulk']
+            return d_ret
+        if isinstance(d_response, dict) and 'bulk' not in d_response and \
+           not d_response.get('status'):
+            d_ret['supported']  = False
+            return d_ret
+        if d_response is not None:
+            str_error   = 'bad bulk service response: %s' % json.dumps(d_response)[:256]
+        self.dp.qprint(str_error, comms = 'error')
+        d_ret['bulk']   = [{
+                            'status':           False,
+                            'serviceCallError': str_error,
+                            'msg':              d_msg
+                          } for d_msg in al_msg]
+        return d_ret
+
+    def serviceCall_batch(self, al_msg, **kwargs):
+        """
+        Send a batch of messages to the service and return the list of
+        responses in the same order as <al_msg>.
+
+        If bulk messages are enabled and the service has not yet shown that
+        it does not support them for this action, the batch is sent as one
+        bulk message. Otherwise (or if the service does not take the bulk
+        message, see serviceCall_bulk()) the messages are sent individually
+        with serviceCall_fanOut(), which also takes the <kwargs>.
+        """
+        d_bulk          = {'status': False}
+
+        if self.b_bulkMessages and len(al_msg) > 1:
+            str_action  = al_msg[0].get('action', '')
+            if self.d_bulkSupported.get(str_action, True) and \
+               all([d_msg.get('action') == str_action and 'meta' in d_msg 
+                    for d_msg in al_msg]):
+                self.dp.qprint('Sending %d %s messages in bulk...' % (len(al_msg), str_action))
+                d_bulk  = self.serviceCall_bulk(al_msg)
+                if not d_bulk['supported']:
+                    self.dp.qprint('Service does not support bulk %s, falling back to per-series messages.' % 
+                                    str_action, comms = 'error')
+                self.d_bulkSupported[str_action]    = d_bulk['supported']
+
+        if d_bulk.get('supported'):
+            return d_bulk['bulk']
+        return self.serviceCall_fanOut(al_msg, **kwargs)
+
     def man_get(self):
         """
         return a simple man/usage paragraph.
@@ -554,22 +2554,189 @@ class PacsRetrieveApp(ChrisApp):
             f.write('studies:   %d\n' % studyHits)
             f.close()
 
+    def queryTableIndex_write(self, str_FQresultFile, d_index, d_studySeries):
+        """
+        Save the byte offsets of the hits in <str_FQresultFile> (as kept 
+        by a JSONStreamWriter), and the number of series hits per study,
+        to <str_FQresultFile>.index.
+        """
+        d_tableIndex    = {
+            'size':         os.path.getsize(str_FQresultFile),
+            'paths':        {'.'.join(path): l_offset for path, l_offset in d_index.items()},
+            'studySeries':  d_studySeries
+        }
+        with open(str_FQresultFile + '.index', 'w') as f:
+            json.dump(d_tableIndex, f)
+
+    def queryTableIndex_read(self, str_FQresultFile):
+        """
+        Return the offset index of <str_FQresultFile>, or None if there
+        is none or it does not match the table.
+        """
+        try:
+            with open(str_FQresultFile + '.index', 'r') as f:
+                d_tableIndex    = json.load(f)
+            if d_tableIndex['size'] == os.path.getsize(str_FQresultFile):
+                return d_tableIndex
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def hitsDB_read(self, *args, **kwargs):
+        """
+        Read the series hits at <indexList> and/or matching <select> from
+        the prior hits database into self.d_queryRow, and return their 
+        rows. Only the selected hits are read, through the indexes of
+        the database.
+        """
+        l_index         = []
+        str_select      = ''
+        for k,v in kwargs.items():
+            if k == 'indexList':    l_index     = v
+            if k == 'select':       str_select  = v
+
+        str_FQhitsDB    = os.path.join(self.str_inputDir, self.str_priorHitsDB)
+        self.dp.qprint('Reading prior data results from %s' % str_FQhitsDB)
+        db              = sqlite3.connect('file:%s?mode=ro' % str_FQhitsDB, uri = True)
+        try:
+            s_column        = set([row[1] for row in db.execute('PRAGMA table_info(series)')])
+            l_condition     = []
+            l_param         = []
+            if len(str_select):
+                selector    = HitsSelector(str_select)
+                self.selectKeys_check(selector, s_column)
+                HitsSelector.sqlFunctions_register(db)
+                str_condition, l_param  = selector.sql_compile(s_column)
+                l_condition.append(str_condition)
+            if len(l_index):
+                l_condition.append('row IN (%s)' % ','.join(['?'] * len(l_index)))
+                l_param.extend(l_index)
+            l_row           = []
+            for row, str_hit in db.execute( 'SELECT row, hit FROM series WHERE %s ORDER BY row' %
+                                            ' AND '.join(l_condition or ['1']), l_param):
+                self.d_queryRow[row]    = self.json_loads(str_hit)
+                l_row.append(row)
+            l_studyUID      = []
+            if 'StudyInstanceUID' in s_column:
+                l_studyUID  = list(set([self.entry_value(self.d_queryRow[row], 'StudyInstanceUID')
+                                        for row in l_row]) - set([None]))
+            if len(l_studyUID):
+                for str_studyUID, count in db.execute(
+                        'SELECT StudyInstanceUID, COUNT(*) FROM series WHERE StudyInstanceUID IN (%s) '
+                        'GROUP BY StudyInstanceUID' % ','.join(['?'] * len(l_studyUID)), l_studyUID):
+                    self.d_studySeries[str_studyUID]    = count
+        finally:
+            db.close()
+        return l_row
+
+    def selectKeys_check(self, selector, s_key):
+        """
+        Warn about keys in the --select expression that no hit has.
+        """
+        for str_key in sorted(selector.keys() - set(s_key)):
+            self.dp.qprint('"%s" in --select is not a key of the hits, its terms do not match.' % 
+                            str_key, comms = 'error')
+
+    def queryTable_select(self, *args, **kwargs):
+        """
+        Read (streaming it with ijson, if available) the series hits of 
+        the prior hits table into a HitsTable, and evaluate <select> on it
+        with per-column indexes. The matching hits, restricted to those at
+        <indexList> if given, are kept in self.d_queryRow. Return their
+        rows.
+        """
+        l_index         = []
+        str_select      = ''
+        for k,v in kwargs.items():
+            if k == 'indexList':    l_index     = v
+            if k == 'select':       str_select  = v
+
+        selector        = HitsSelector(str_select)
+        str_FQresultFile    = os.path.join(self.str_inputDir, self.str_priorHitsTable)
+        self.dp.qprint('Selecting from prior data results in %s' % str_FQresultFile )
+        table           = HitsTable()
+        with open(str_FQresultFile, 'rb') as f:
+            if ijson:
+                for d_hit in ijson.items(f, 'query.data.item', use_float = True):
+                    table.row_append(d_hit)
+            else:
+                for d_hit in self.json_loads(f.read())['query']['data']:
+                    table.row_append(d_hit)
+        self.selectKeys_check(selector, table.d_schema)
+        s_row           = selector.rows_select(table)
+        if len(l_index):
+            s_row      &= set([index % len(table) for index in l_index 
+                                if -len(table) <= index < len(table)])
+        l_row           = sorted(s_row)
+        for row in l_row:
+            self.d_queryRow[row]    = table.row_dict(row)
+        for str_studyUID, l_studyRow in selector.column_index(table, 'StudyInstanceUID').items():
+            self.d_studySeries[str_studyUID]    = len(l_studyRow)
+        return l_row
+
     def queryTable_read(self, *args, **kwargs):
         """
         Read a JSON formatted query table generated by 'pacsquery'.
+
+        If there is a prior hits database, the series hits are read from
+        it instead (see hitsDB_read()). With a <select> expression, the
+        hits that match (see queryTable_select() for a table) become the
+        self.l_indexList to retrieve.
+
+        Only the series hits at <indexList> are materialized, into 
+        self.d_queryRow (keyed on their index). They are read at their
+        offsets in the table if it has an index, else streamed from the
+        table with ijson; only without either is the table read in full
+        (into self.d_query).
         """
 
-        d_results       = {}
-        options         = None
+        l_index         = []
+        str_select      = ''
         for k,v in kwargs.items():
             if k == 'priorHitsTable':   self.str_priorHitsTable = v
-
-        if len(self.str_priorHitsTable):
+            if k == 'priorHitsDB':      self.str_priorHitsDB    = v
+            if k == 'indexList':        l_index                 = v
+            if k == 'select':           str_select              = v
+
+        if len(self.str_priorHitsDB):
+            l_row           = self.hitsDB_read(indexList = l_index, select = str_select)
+            if len(str_select):
+                self.l_indexList    = [str(row) for row in l_row]
+        elif len(self.str_priorHitsTable) and len(str_select):
+            l_row           = self.queryTable_select(indexList = l_index, select = str_select)
+            self.l_indexList    = [str(row) for row in l_row]
+        elif len(self.str_priorHitsTable):
             str_FQresultFile    = os.path.join(self.str_inputDir, self.str_priorHitsTable)
             self.dp.qprint('Reading prior data results from %s' % str_FQresultFile )
-            f = open(str_FQresultFile, 'r')
-            self.d_query = json.load(f)
-            f.close()
+            d_tableIndex        = self.queryTableIndex_read(str_FQresultFile)
+            s_index             = set(l_index)
+            if d_tableIndex:
+                self.d_studySeries  = d_tableIndex.get('studySeries', {})
+                l_offset        = d_tableIndex['paths'].get('query.data', [])
+                with open(str_FQresultFile, 'rb') as f:
+                    for index in sorted(s_index):
+                        if not -len(l_offset) <= index < len(l_offset): continue
+                        offset, length  = l_offset[index]
+                        f.seek(offset)
+                        self.d_queryRow[index]  = self.json_loads(f.read(length))
+            elif ijson and s_index and min(s_index) >= 0:
+                with open(str_FQresultFile, 'rb') as f:
+                    for index, d_hit in enumerate(ijson.items(f, 'query.data.item', 
+                                                                use_float = True)):
+                        if index in s_index:
+                            self.d_queryRow[index]  = d_hit
+                            if len(self.d_queryRow) == len(s_index): break
+            else:
+                with open(str_FQresultFile, 'r') as f:
+                    self.d_query    = json.load(f)
+                l_data          = self.d_query['query']['data']
+                for d_hit in l_data:
+                    str_studyUID    = self.entry_value(d_hit, 'StudyInstanceUID')
+                    if str_studyUID:
+                        self.d_studySeries[str_studyUID]    = self.d_studySeries.get(str_studyUID, 0) + 1
+                for index in s_index:
+                    if -len(l_data) <= index < len(l_data):
+                        self.d_queryRow[index]  = l_data[index]
 
     def dataReport_process(self, *args, **kwargs):
         """
@@ -584,10 +2751,8 @@ class PacsRetrieveApp(ChrisApp):
         if len(self.str_resultFile):
             str_FQresultFile    = os.path.join(self.str_outputDir, self.str_resultFile)
             self.dp.qprint('Saving data results to %s' % str_FQresultFile )
-            f = open(str_FQresultFile, 'w')
-            js_results  = json.dumps(d_results, sort_keys = True, indent = 4)
-            f.write('%s' % js_results)
-            f.close()
+            with open(str_FQresultFile, 'wb') as f:
+                JSONStreamWriter(f, backend = self.jsonBackend_get()).value_write(d_results)
 
     def ageCalc(self, astr_birthDate, astr_scanDate):
         """
@@ -612,6 +2777,63 @@ class PacsRetrieveApp(ChrisApp):
             str_age = '%03dY' % (dateDiff.days / 365.25)
         return str_age
 
+    def patientAge_get(self, astr_birthDate, astr_scanDate):
+        """
+        Return the (memoized) age at scan time, computing it with 
+        ageCalc() for a pair of dates not seen before.
+        """
+        pair    = (astr_birthDate, astr_scanDate)
+        if pair not in self.d_patientAge:
+            self.d_patientAge[pair] = self.ageCalc(astr_birthDate, astr_scanDate)
+        return self.d_patientAge[pair]
+
+    def patientAge_batchCalc(self, al_entry):
+        """
+        Compute, in one go, the ages of all the hits in <al_entry> that 
+        have no PatientAge of their own, and memoize them on their 
+        (PatientBirthDate, StudyDate).
+
+        Each distinct pair of dates is parsed once, and the differences
+        are computed and binned with NumPy datetime64 arithmetic. The 
+        rounding and D/W/M/Y formatting are those of ageCalc(). Pairs 
+        that are not valid YYYYMMDD dates are left to ageCalc() if NumPy
+        is not available or cannot parse them.
+        """
+        s_pair      = set()
+        for d_entry in al_entry:
+            try:
+                d_entry['PatientAge']['value']
+                continue
+            except (KeyError, TypeError):
+                pass
+            try:
+                pair    = ( d_entry['PatientBirthDate']['value'], 
+                            d_entry['StudyDate']['value'])
+            except (KeyError, TypeError):
+                continue
+            if pair not in self.d_patientAge:
+                s_pair.add(pair)
+        if not s_pair or not numpy:
+            return len(s_pair)
+
+        l_pair      = [pair for pair in s_pair 
+                        if all(len(str_date) == 8 and str_date.isdigit() for str_date in pair)]
+        try:
+            l_birth     = ['%s-%s-%s' % (b[0:4], b[4:6], b[6:8]) for b, s in l_pair]
+            l_scan      = ['%s-%s-%s' % (s[0:4], s[4:6], s[6:8]) for b, s in l_pair]
+            days        = ( numpy.array(l_scan,  dtype = 'datetime64[D]') - 
+                            numpy.array(l_birth, dtype = 'datetime64[D]')).astype(numpy.int64)
+        except ValueError:
+            return len(s_pair)
+        divisor     = numpy.select( [days < 31, days < (9*30.42), days < (2*365.25)],
+                                    [1.0, 7.0, 30.42], 365.25)
+        unit        = numpy.select( [days < 31, days < (9*30.42), days < (2*365.25)],
+                                    ['D', 'W', 'M'], 'Y')
+        age         = numpy.trunc(days / divisor).astype(numpy.int64)
+        for pair, value, str_unit in zip(l_pair, age.tolist(), unit.tolist()):
+            self.d_patientAge[pair] = '%03d%s' % (value, str_unit)
+        return len(s_pair)
+
     def entry_reprocessForKey(self, *args, **kwargs):
         """
         Reprocess a key/entry for special handling
@@ -629,63 +2851,70 @@ class PacsRetrieveApp(ChrisApp):
             # between the ScanDate and the PatientBirthDate
             str_scanDate    = d_entry['StudyDate']['value']
             str_birthDate   = d_entry['PatientBirthDate']['value']
-            str_ret         = self.ageCalc(str_birthDate, str_scanDate)
+            str_ret         = self.patientAge_get(str_birthDate, str_scanDate)
 
         return str_ret
 
-    def summaryReport_process(self, *args, **kwargs):
+    def entry_value(self, d_entry, str_key):
         """
-        Generate a summary report based on CLI specs
+        Return the value of <str_key> in the hits <d_entry>, or None if it
+        has none.
         """
+        try:
+            value   = d_entry[str_key]['value']
+        except (KeyError, TypeError):
+            return None
+        return None if value == 'no value provided' else value
 
-        l_dataStudy                 = []
-        l_dataSeries                = []
-        # self.str_seriesSummaryKeys  = ''
-        # self.str_studySummaryKeys   = ''
-        for k,v in kwargs.items():
-            # if k == 'seriesSummaryKeys':    self.str_seriesSummaryKeys  = v
-            # if k == 'seriesSummaryFile':    self.str_seriesSummaryFile  = v
-            # if k == 'studySummaryKeys':     self.str_studySummaryKeys   = v
-            # if k == 'studySummaryFile':     self.str_studySummaryFile   = v
-            if k == 'dataStudy':            l_dataStudy                 = v
-            if k == 'dataSeries':           l_dataSeries                = v
-        
-        pudb.set_trace()
-        for report in ['series', 'study']:
-            str_report      = ''
-            if report == 'series':  
-                l_data              = l_dataSeries
-                l_summaryKeys       = self.str_seriesSummaryKeys.split(',')
-                str_summaryFile     = self.str_seriesSummaryFile
-            if report == 'study':   
-                l_data              = l_dataStudy
-                l_summaryKeys       = self.str_studySummaryKeys.split(',')
-                str_summaryFile     = self.str_studySummaryFile
-
-            if len(l_data):
-                # Header
-                for key in l_summaryKeys:
-                    str_report  = str_report + "%-60s\t" % key
-
-                # Body
-                for entry in l_data:
-                    str_report  = str_report + "\n"
-                    for key in l_summaryKeys:
-                        try:
-                            str_value   = entry[key]['value']
-                        except:
-                            str_value   = self.entry_reprocessForKey(
-                                                entry   = entry, 
-                                                key     = key
-                                                )
-                        str_report  = str_report + "%-60s\t" % (str_value)
-
-            if len(str_summaryFile):
+    def entry_valueGet(self, d_entry, str_key):
+        """
+        Return the summary value of <str_key> in the hits <d_entry>.
+        """
+        try:
+            if isinstance(d_entry, HitsRow):
+                return d_entry.value(str_key)
+            return d_entry[str_key]['value']
+        except (KeyError, TypeError):
+            return self.entry_reprocessForKey(
+                                entry   = d_entry,
+                                key     = str_key
+                                )
+
+    def options_check(self):
+        """
+        Check the values of options that are one of a set of choices, and
+        raise a ValueError for a bad one before any work is done.
+        """
+        SummaryReportWriter.format_check(self.str_summaryFormat)
+        if self.str_pullMode not in ['service', 'local']:
+            raise ValueError('unknown pull mode "%s", expected one of service|local' %
+                                self.str_pullMode)
+        if self.str_pullMode == 'local':
+            if not smdb:
+                raise ValueError("the 'local' pull mode needs pypx.smdb (pypx>=3.12.6)")
+            str_error   = self.smdbDir_check()
+            if len(str_error):
+                raise ValueError(str_error)
+
+    def summaryReport_writers(self):
+        """
+        Return a dictionary of summary report writers, keyed on the
+        report ('series' or 'study'), for each report with keys and a file.
+        """
+        d_writer    = {}
+        for report, str_summaryKeys, str_summaryFile in [
+                ('series',  self.str_seriesSummaryKeys, self.str_seriesSummaryFile),
+                ('study',   self.str_studySummaryKeys,  self.str_studySummaryFile)]:
+            if len(str_summaryKeys) and len(str_summaryFile):
                 str_FQsummaryFile   = os.path.join(self.str_outputDir, str_summaryFile) 
                 self.dp.qprint('Saving %s summary to %s' % (report, str_FQsummaryFile) )
-                f = open(str_FQsummaryFile, 'w')
-                f.write(str_report)
-                f.close()
+                d_writer[report]    = SummaryReportWriter(
+                                            str_FQsummaryFile,
+                                            str_summaryKeys.split(','),
+                                            valueGet    = self.entry_valueGet,
+                                            format      = self.str_summaryFormat
+                                            )
+        return d_writer
 
     def directMessage_checkAndConstruct(self, options):
         """
@@ -730,19 +2959,47 @@ class PacsRetrieveApp(ChrisApp):
             }
             self.b_canRun   = True
 
+    def indexList_parse(self, str_indexList):
+        """
+        Return the comma separated <str_indexList> as a list of index
+        strings, without duplicates (in first seen order).
+        """
+        l_index     = [str(int(series)) for series in str_indexList.split(',') 
+                        if len(series.strip())]
+        l_unique    = list(dict.fromkeys(l_index))
+        if len(l_unique) < len(l_index):
+            self.dp.qprint('Dropping %d duplicate(s) in --indexList.' % 
+                            (len(l_index) - len(l_unique)), comms = 'error')
+        return l_unique
+
     def retrieveMessage_checkAndConstructBase(self, options):
         """
         Checks if user specified a retrieve from a pattern of command line flags,
-        and if so, construct the base message.
+        and if so, construct the base message for each series of the (parsed,
+        or selected) self.l_indexList.
+
+        Indices that name a series already in the list (e.g. '6,-1' in a
+        table of 7 hits) are dropped from self.l_indexList.
 
         Return True/False accordingly
         """
 
-        if len(options.str_priorHitsTable) and len(options.str_indexList):
-            self.l_indexList = options.str_indexList.split(',')
+        if  (len(options.str_priorHitsTable) or len(options.str_priorHitsDB)) and \
+            (len(options.str_indexList) or len(options.str_select)):
             self.str_PACSservice    = options.str_PACSservice
+            self.seriesHits     = HitsTable()
+            l_index             = []
             for series in self.l_indexList:
-                str_seriesUID       = self.d_query['query']['data'][int(series)]['SeriesInstanceUID']['value']
+                if int(series) not in self.d_queryRow:
+                    raise IndexError('series %s is not in the hits table' % series)
+                str_seriesUID       = self.d_queryRow[int(series)]['SeriesInstanceUID']['value']
+                if str_seriesUID in self.d_seriesHits:
+                    self.dp.qprint('Dropping index %s, the same series as an earlier index (%s).' %
+                                    (series, str_seriesUID), comms = 'error')
+                    continue
+                l_index.append(series)
+                d_hit               = self.seriesHits[self.seriesHits.row_append(self.d_queryRow[int(series)])]
+                self.d_seriesHits[str_seriesUID]    = d_hit
                 self.l_dmsg.append({
                     'action':   'PACSinteract',
                     'meta': {
@@ -753,6 +3010,7 @@ class PacsRetrieveApp(ChrisApp):
                         "PACS": self.str_PACSservice
                     }
                 })
+            self.l_indexList    = l_index
             self.b_canRun   = True
             return self.b_canRun
 
@@ -773,80 +3031,106 @@ class PacsRetrieveApp(ChrisApp):
                 d['meta'][k] = v
         return self.b_canRun
 
-    def retrieveMessageStatus_checkAndConstruct(self):
+    def pullDirTemplate_compile(self):
         """
-        Construct a status check on a retrieve event. Essentially, this replaces the
-        'retrieve' string with a 'retrieveStatus' in the already existing message
-        payload. 
-
-        PRECONDITIONS
-        * A populated self.l_dmsg list of dictionaries -- typically created by a 
-          prior call to self.retrieveMessage_checkAndConstruct()
-
-        POSTCONDITIONS
-        * Return True/False accordingly
+        Parse the --pullDirTemplate once, and record the list of DICOM tags
+        (i.e. the '%<tag>' fields) that it references.
         """
-
-        for d in self.l_dmsg:
-            d['meta']['do'] = 'retrieveStatus'
-        return self.b_canRun
+        self.str_pullDirTemplate        = self.options.str_pullDirTemplate
+        self.l_pullDirTemplateTags      = []
+        for str_tag in self.pullDirTemplate_re.findall(self.str_pullDirTemplate):
+            if str_tag not in self.l_pullDirTemplateTags:
+                self.l_pullDirTemplateTags.append(str_tag)
+        return self.l_pullDirTemplateTags
+
+    def DICOMtags_get(self, str_seriesUID):
+        """
+        Ask the service for the DICOM tags of a series. The response is
+        cached, so the service is asked at most once per series.
+        """
+        with self.lock_DICOMtags:
+            if str_seriesUID in self.d_DICOMtags:
+                return self.d_DICOMtags[str_seriesUID]
+
+        d_dicomTag_getCommand   = {
+            'action':   'internalDB',
+            'meta': {
+                'do':   'DICOMtagsGet',
+                'on': {
+                    'series_uid':   str_seriesUID
+                }
+            }
+        }
+        d_tags  = self.service_call(msg = d_dicomTag_getCommand)
+        with self.lock_DICOMtags:
+            self.d_DICOMtags[str_seriesUID] = d_tags
+        return d_tags
 
     def retrieveMessageCopy_localPathDetermine(self, *args, **kwargs):
         """
         Determine the local path name based on seriesUID and directory
         template.
+
+        The tags in the template are resolved from the hits table entry
+        of the series. Only if some tag is not in the hits table is the
+        service asked (once per series) for the DICOM tags of the series.
         """
         str_seriesUID   = ''
         b_status        = False
-        d_ret           = {}
-        str_path        = self.options.str_pullDirTemplate
+        d_value         = {}
+        l_missing       = []
 
         for k, v in kwargs.items():
             if k == 'seriesUID':   str_seriesUID    = v 
 
+        if self.l_pullDirTemplateTags is None: self.pullDirTemplate_compile()
+        str_path        = self.str_pullDirTemplate
+
         if len(str_seriesUID):
-            d_dicomTag_getCommand   = {
-                'action':   'internalDB',
-                'meta': {
-                    'do':   'DICOMtagsGet',
-                    'on': {
-                        'series_uid':   str_seriesUID
-                    }
-                }
-            }
-            d_tags  = self.service_call(msg = d_dicomTag_getCommand)
-            if d_tags['status']:
-                d_dicom = d_tags['DICOMtagsGet']['d_dicom']
-                for el in d_dicom.keys():
-                    str_replaceTag  = '%%%s' % el
-                    s               = d_dicom[el]
-                    s               = re.sub(r'[^\w\s-]', '', s).strip()
-                    s               = re.sub(r"\s+", '_', s)
-                    str_path        = str_path.replace(str_replaceTag, s)
+            d_hit       = self.d_seriesHits.get(str_seriesUID, {})
+            for str_tag in self.l_pullDirTemplateTags:
+                try:
+                    value   = d_hit[str_tag]['value']
+                except:
+                    value   = 'no value provided'
+                if value == 'no value provided':
+                    l_missing.append(str_tag)
+                else:
+                    d_value[str_tag]    = value
+            b_status    = True
+
+            if len(l_missing):
+                d_tags  = self.DICOMtags_get(str_seriesUID)
+                if d_tags['status']:
+                    d_dicom = d_tags['DICOMtagsGet']['d_dicom']
+                    for str_tag in l_missing:
+                        if str_tag in d_dicom: d_value[str_tag] = d_dicom[str_tag]
                 b_status    = d_tags['status']
 
+            def tag_replace(match):
+                if match.group(1) not in d_value: return match.group(0)
+                s   = '%s' % d_value[match.group(1)]
+                s   = re.sub(r'[^\w\s-]', '', s).strip()
+                s   = re.sub(r"\s+", '_', s)
+                return s
+            str_path    = self.pullDirTemplate_re.sub(tag_replace, str_path)
+
         return {
             'status':   b_status,
             'path':     str_path
         }
 
-    def retrieveMessageCopy_checkAndConstruct(self):
+    def retrieveMessageCopy_construct(self, al_done):
         """
-        Construct a message that will ask the pfdcm to copy a dirtree
-        from one location to another in its filesystem space.
-
-        PRECONDITIONS
-        * Successful retrieve call.
+        For each successful retrieve status in <al_done>, determine the
+        local path and construct the 'pullPath' message for that series.
 
-        POSTCONDITIONS
-        * Return True/False accordingly
+        Return a list of dictionaries with the 'seriesUID', 'path' and 'msg'
+        of each series. This does not touch any object state and so is safe
+        to call from the retrieve pipeline threads.
         """
-    
-        # pudb.set_trace()
-        self.b_canRun           = False
-        self.l_dmsg             = []
-        self.lstr_outputPull    = []
-        for d_copy in self.l_retrieveOK:
+        l_ret   = []
+        for d_copy in al_done:
             str_seriesUID   = d_copy['retrieveStatus']['seriesUID']
             d_path          = self.retrieveMessageCopy_localPathDetermine(seriesUID = str_seriesUID)
             if d_path['status']:
@@ -854,47 +3138,97 @@ class PacsRetrieveApp(ChrisApp):
             else:
                 str_localDest   = '%s-notemplate' % str_seriesUID
             str_localPath       = os.path.join(self.str_outputDir, str_localDest)
-            self.lstr_outputPull.append(str_localPath)
-            self.l_dmsg.append({
-                'action':   'pullPath',
-                'meta': {
-                    'on': {
-                        'series_uid': str_seriesUID
-                    },
-                    'to': {
-                        'path':         str_localPath,
-                        "createDir":    True
-                    }                
+            l_ret.append({
+                'seriesUID':    str_seriesUID,
+                'path':         str_localPath,
+                'msg': {
+                    'action':   'pullPath',
+                    'meta': {
+                        'on': {
+                            'series_uid': str_seriesUID
+                        },
+                        'to': {
+                            'path':         str_localPath,
+                            "createDir":    True
+                        }                
+                    }
                 }
             })
-        self.b_canRun   = True
-        return self.b_canRun
+        return l_ret
 
     def outputFiles_generate(self, options, d_ret, l_dataStudy, l_dataSeries):
         """
         Check and generate output files.
+
+        All reports are fed in a single pass over the query results: the
+        results are walked (and, if asked for, streamed to the result
+        file) once, and each series and study entry is counted and added
+        to the summary reports as it goes by.
         """
-        if len(options.str_numberOfHitsFile):
-            self.numberOfHitsReport_process(
-                                        studyHits   = len(l_dataStudy),
-                                        seriesHits  = len(l_dataSeries),
-                                        hitsFile    = options.str_numberOfHitsFile
-                                        )
+        d_hits      = {'series': 0, 'study': 0}
+        d_writer    = {}
+        if len(options.str_seriesSummaryKeys) or len(options.str_studySummaryKeys):
+            d_writer    = self.summaryReport_writers()
+
+        hitsDB      = None
+        if len(options.str_hitsDB):
+            str_FQhitsDB    = os.path.join(self.str_outputDir, options.str_hitsDB)
+            self.dp.qprint('Saving hits database to %s' % str_FQhitsDB)
+            hitsDB          = HitsDBWriter(str_FQhitsDB)
+
+        d_studySeries   = {}
+
+        def listener_make(report):
+            writer      = d_writer.get(report)
+            def listener(entry):
+                if writer: writer.row_add(entry)
+                if hitsDB: hitsDB.row_add(report, d_hits[report], entry)
+                d_hits[report]     += 1
+                if report == 'series':
+                    str_studyUID    = self.entry_value(entry, 'StudyInstanceUID')
+                    if str_studyUID:
+                        d_studySeries[str_studyUID] = d_studySeries.get(str_studyUID, 0) + 1
+            return listener
+
+        if 'PatientAge' in ('%s,%s' % ( options.str_seriesSummaryKeys,
+                                        options.str_studySummaryKeys)).split(','):
+            self.patientAge_batchCalc(l_dataSeries)
+            self.patientAge_batchCalc(l_dataStudy)
+
+        d_listeners = {
+            ('query', 'data'):      [listener_make('series')],
+            ('query', 'dataStudy'): [listener_make('study')]
+        }
 
+        fd          = None
         if len(options.str_resultFile):
-            self.dataReport_process     (    
-                                        results     = d_ret,
-                                        resultFile  = options.str_resultFile
-                                        )
+            self.str_resultFile = options.str_resultFile
+            str_FQresultFile    = os.path.join(self.str_outputDir, self.str_resultFile)
+            self.dp.qprint('Saving data results to %s' % str_FQresultFile )
+            fd                  = open(str_FQresultFile, 'wb')
+        writer      = JSONStreamWriter( fd, 
+                                        backend     = self.jsonBackend_get(),
+                                        listeners   = d_listeners,
+                                        indexPaths  = d_listeners.keys())
+        try:
+            writer.value_write(d_ret)
+        except:
+            if hitsDB: hitsDB.abort()
+            raise
+        finally:
+            if fd: fd.close()
+            for summaryWriter in d_writer.values():
+                summaryWriter.close()
+        if hitsDB:
+            hitsDB.close()
+        if fd:
+            self.queryTableIndex_write(str_FQresultFile, writer.d_index, d_studySeries)
 
-        if len(options.str_seriesSummaryKeys) or len(options.str_studySummaryKeys):
-            self.summaryReport_process  ( 
-                                        dataStudy           = l_dataStudy,
-                                        dataSeries          = l_dataSeries
-                                        # seriesSummaryKeys   = options.str_seriesSummaryKeys,
-                                        # seriesSummaryFile   = options.str_seriesSummaryFile,
-                                        # studySummaryKeys    = options.str_studySummaryKeys,
-                                        # studySummaryFile    = options.str_studySummaryFile
+        if len(options.str_numberOfHitsFile):
+            self.numberOfHitsReport_process(
+                                        studyHits   = d_hits['study'],
+                                        seriesHits  = d_hits['series'],
+                                        hitsFile    = options.str_numberOfHitsFile
                                         )
        
     def query_run(self, options):
@@ -906,6 +3240,10 @@ class PacsRetrieveApp(ChrisApp):
 
         if self.b_canRun:
             d_ret           = self.service_call(msg = self.d_msg)
+            # Keep the hits in compact tables, that are converted back to
+            # the JSON layout only as they are written out
+            for str_data in ['data', 'dataStudy']:
+                d_ret['query'][str_data]    = HitsTable(d_ret['query'][str_data])
             l_dataSeries    = d_ret['query']['data']
             l_dataStudy     = d_ret['query']['dataStudy']
             hitsSeries      = len(l_dataSeries)
@@ -921,13 +3259,20 @@ class PacsRetrieveApp(ChrisApp):
         Cycle once through the scheduled retrieves and 
         build a list of return status.
 
+        The status checks are sent with a fan-out of up to
+        self.maxConcurrentStatusChecks calls, and the returned list is in
+        the same order as <al_call>, as expected by
+        retrieveStatus_filterPending(). A check that fails outright is
+        returned with a False 'status' and is thus simply kept pending.
         """
         l_ret           = []
 
         if self.b_canRun:
-            for self.d_msg in al_call:
-                self.dp.qprint('Asking the dcm service for updates on reception of PACS data...')
-                l_ret.append(self.service_call(msg = self.d_msg))
+            l_ret       = self.serviceCall_batch(
+                            al_call,
+                            workers = self.maxConcurrentStatusChecks,
+                            note    = 'Asking the dcm service for updates on reception of PACS data...'
+                        )
         return l_ret
         
     def retrieveStatus_filterPending(self, al_checkCall, al_checkResult):
@@ -974,166 +3319,1057 @@ class PacsRetrieveApp(ChrisApp):
                                                 l_retrieveStatus)
         return d_ret
 
+    def seriesHits_instanceCount(self, str_seriesUID):
+        """
+        Return the 'NumberOfSeriesRelatedInstances' of a series as recorded
+        in the hits table, or 0 if this is not known.
+        """
+        try:
+            return int(self.d_seriesHits[str_seriesUID]['NumberOfSeriesRelatedInstances']['value'])
+        except:
+            return 0
+
+    def retrieveStatus_pollInterval(self, d_call, **kwargs):
+        """
+        Return the (unjittered) wait before the next status check on the
+        retrieve in <d_call>.
+
+        The first wait is the expected completion time of the series, based
+        on its number of instances, and each subsequent wait doubles the
+        <previous> one. Either way the wait is kept within the 
+        [pollIntervalMin, pollIntervalMax] range.
+        """
+        previous        = 0.0
+        for k, v in kwargs.items():
+            if k == 'previous':     previous    = v
+
+        if previous:
+            interval    = previous * 2
+        else:
+            str_seriesUID   = d_call['meta']['on'].get('series_uid', '')
+            interval        = self.seriesHits_instanceCount(str_seriesUID) / \
+                                max(self.instancesPerSecond, 1e-6)
+        return min(max(interval, self.pollIntervalMin), self.pollIntervalMax)
+
     def retrieveStatus_process(self, al_checkCall, **kwargs):
         """
         Process the retrieve status by waiting until 
         all asynchronous retrieves have completed.
+
+        Each pending retrieve is polled on its own schedule (see
+        retrieveStatus_pollInterval()), with some jitter so that polls
+        do not synchronize. All retrieves are waited on for at most 
+        self.retrieveTimeout seconds in total -- retrieves still pending
+        by then are dropped, and listed in 'timedOutCalls'.
+
+        If an <onDone> callable is passed, it is called with the list of
+        results that are found to be done in each polling cycle, so that
+        these can be processed while other retrieves are still pending.
+
+        If an <admit> callable is passed, it is called with the list of 
+        calls still pending after each polling cycle, and returns a list
+        of further calls to poll, for retrieves it has just started. It is
+        no longer called once self.retrieveTimeout has passed.
         """
         
         b_jobsPending           = True
         b_breakCondition        = False
         b_waitForPending        = True
-        sleepInterval           = 5
+        fn_onDone               = None
+        fn_admit                = None
         l_retrieveStatus        = []
         l_checkCall             = []
+        l_timedOut              = []
+        # Per pending call schedule, keyed on id() of the call
+        d_schedule              = {}
 
         self.l_retrieveOK       = []
 
         for k, v in kwargs.items():
             if k == 'waitForPending':   b_waitForPending = v
+            if k == 'onDone':           fn_onDone        = v
+            if k == 'admit':            fn_admit         = v
+
+        def calls_schedule(al_call, start):
+            for d_call in al_call:
+                interval            = self.retrieveStatus_pollInterval(d_call)
+                d_schedule[id(d_call)]  = {
+                    'interval':     interval,
+                    'nextPoll':     start + interval * \
+                                    random.uniform(1 - self.pollJitter, 1 + self.pollJitter),
+                    'deadline':     startTime + self.retrieveTimeout
+                }
+
+        def admit_open():
+            return self.retrieveTimeout <= 0 or time.time() < startTime + self.retrieveTimeout
 
         # pudb.set_trace()
 
+        startTime               = time.time()
         d_ret                   = self.retrieveStatus_callAndFilter(al_checkCall)
         b_jobsPending           = d_ret['status']
         for done in d_ret['doneResults']: self.l_retrieveOK.append(done)
         self.dp.qprint('Done list len = %d' % len(self.l_retrieveOK))
+        if fn_onDone and len(d_ret['doneResults']): fn_onDone(d_ret['doneResults'])
+
+        l_checkCall             = list(d_ret['pendingCalls'])
+        l_retrieveStatus        = list(d_ret['pendingResults'])
+        calls_schedule(l_checkCall, startTime)
+        if fn_admit and b_waitForPending and admit_open():
+            l_admitted          = fn_admit(l_checkCall)
+            calls_schedule(l_admitted, time.time())
+            l_checkCall        += l_admitted
+            l_retrieveStatus   += [{} for d_call in l_admitted]
+            b_jobsPending       = len(l_checkCall) > 0
 
         while b_jobsPending and not b_breakCondition and b_waitForPending:
-            self.dp.qprint('Pending retrieve jobs detected. Sleeping for %d seconds...' % sleepInterval)
-            time.sleep(sleepInterval)
-
-            self.dp.qprint('Reprocessing retrieve status for pending jobs...')
-            d_ret               = self.retrieveStatus_callAndFilter(d_ret['pendingCalls'])
-            b_jobsPending       = d_ret['status']
+            now                 = time.time()
+            nextPoll            = min([d_schedule[id(d)]['nextPoll'] for d in l_checkCall])
+            if self.retrieveTimeout > 0:
+                nextPoll        = min([nextPoll] + [d_schedule[id(d)]['deadline'] for d in l_checkCall])
+            if nextPoll > now:
+                self.dp.qprint('Pending retrieve jobs detected. Sleeping for %.2f seconds...' % 
+                                (nextPoll - now))
+                time.sleep(nextPoll - now)
+
+            now                 = time.time()
+            if self.retrieveTimeout > 0:
+                s_expired       = set([id(d) for d in l_checkCall if d_schedule[id(d)]['deadline'] <= now])
+                for d_call in [d for d in l_checkCall if id(d) in s_expired]:
+                    self.dp.qprint('Timed out after %d seconds waiting on retrieve of %s' %
+                                    (self.retrieveTimeout, d_call['meta']['on']),
+                                    comms = 'error')
+                    l_timedOut.append(d_call)
+                l_retrieveStatus    = [d for d, c in zip(l_retrieveStatus, l_checkCall) if id(c) not in s_expired]
+                l_checkCall         = [d for d in l_checkCall if id(d) not in s_expired]
+
+            l_due               = [d for d in l_checkCall if d_schedule[id(d)]['nextPoll'] <= now]
+            s_due               = set([id(d) for d in l_due])
+            self.dp.qprint('Reprocessing retrieve status for %d of %d pending jobs...' %
+                            (len(l_due), len(l_checkCall)))
+            d_check             = self.retrieveStatus_callAndFilter(l_due)
 
             # Update a master list of done results...
-            for done in d_ret['doneResults']: self.l_retrieveOK.append(done)
+            for done in d_check['doneResults']: self.l_retrieveOK.append(done)
             self.dp.qprint('Done list len = %d' % len(self.l_retrieveOK))
-        
+            if fn_onDone and len(d_check['doneResults']): fn_onDone(d_check['doneResults'])
+
+            # ... and back off on the calls that are still pending
+            d_pendingResult     = {}
+            for d_call, d_result in zip(d_check['pendingCalls'], d_check['pendingResults']):
+                d_pendingResult[id(d_call)]     = d_result
+                d_sched                         = d_schedule[id(d_call)]
+                d_sched['interval']             = self.retrieveStatus_pollInterval(
+                                                    d_call,
+                                                    previous = d_sched['interval'])
+                d_sched['nextPoll']             = now + d_sched['interval'] * \
+                                                    random.uniform( 1 - self.pollJitter,
+                                                                    1 + self.pollJitter)
+            l_pending           = []
+            l_pendingResult     = []
+            for d_call, d_result in zip(l_checkCall, l_retrieveStatus):
+                if id(d_call) in s_due and id(d_call) not in d_pendingResult: continue
+                l_pending.append(d_call)
+                l_pendingResult.append(d_pendingResult.get(id(d_call), d_result))
+            l_checkCall         = l_pending
+            l_retrieveStatus    = l_pendingResult
+
+            # ... and start more retrieves, if any are waiting
+            if fn_admit and admit_open():
+                l_admitted      = fn_admit(l_checkCall)
+                calls_schedule(l_admitted, time.time())
+                l_checkCall    += l_admitted
+                l_retrieveStatus   += [{} for d_call in l_admitted]
+            b_jobsPending       = len(l_checkCall) > 0
+
+        d_ret                   = {
+            'status':               b_jobsPending,
+            'pendingResults':       l_retrieveStatus,
+            'doneResults':          self.l_retrieveOK,
+            'pendingCalls':         l_checkCall,
+            'timedOutCalls':        l_timedOut
+        }
         return d_ret
 
-    def retrieve_initiate(self, options):
+    def retrievePlan_build(self, al_call):
         """
-        Initiate the actual retrieve calls to the PACS of interest.
+        Return the list of retrieve units for the per series calls in 
+        <al_call>: each is a {'msg', 'calls', 'study', 'instances'} with
+        the 'retrieve' message, the per series calls it covers, their 
+        StudyInstanceUID and their total number of instances.
+
+        With self.b_studyRetrieve, the series are grouped on their 
+        StudyInstanceUID, and a study (of more than one series) whose 
+        series in the prior hits are all in <al_call> is retrieved with a
+        single study level message. Other series are retrieved one by 
+        one. Status checks and pulls remain per series in any case.
         """
-        l_ret = []
+        d_study     = {}
+        for d_call in al_call:
+            str_seriesUID   = d_call['meta']['on'].get('series_uid', '')
+            str_studyUID    = None
+            if str_seriesUID in self.d_seriesHits:
+                str_studyUID    = self.entry_value(self.d_seriesHits[str_seriesUID], 'StudyInstanceUID')
+            d_study.setdefault(str_studyUID or ('series', str_seriesUID), []).append(d_call)
+
+        def unit_make(d_msg, l_call, study):
+            return {
+                'msg':          d_msg,
+                'calls':        l_call,
+                'study':        study,
+                'instances':    sum([self.seriesHits_instanceCount(d_call['meta']['on'].get('series_uid', ''))
+                                        for d_call in l_call])
+            }
 
-        if self.b_canRun:
-            for self.d_msg in self.l_dmsg:
-                self.dp.qprint('Messaging the dcm service to initiate a PACS retrieve...')
-                l_ret.append(self.service_call(msg = self.d_msg))
+        l_unit      = []
+        for study, l_call in d_study.items():
+            if  self.b_studyRetrieve and not isinstance(study, tuple) and len(l_call) > 1 and \
+                self.d_studySeries.get(study) == len(l_call):
+                l_unit.append(unit_make(dict(l_call[0], meta = dict(l_call[0]['meta'], 
+                                                                    do = 'retrieve',
+                                                                    on = {'study_uid': study})),
+                                        l_call, study))
+            else:
+                l_unit.extend([unit_make(dict(d_call, meta = dict(d_call['meta'], do = 'retrieve')),
+                                         [d_call], study)
+                                for d_call in l_call])
+        d_position  = dict([(id(d_call), i) for i, d_call in enumerate(al_call)])
+        l_unit.sort(key = lambda d_unit: d_position[id(d_unit['calls'][0])])
+        if len(l_unit) < len(al_call):
+            self.dp.qprint('Planned %d retrieve messages for %d series.' % 
+                            (len(l_unit), len(al_call)))
+        return l_unit
+
+    def retrievePlan_order(self, al_unit):
+        """
+        Return the retrieve units <al_unit> in self.str_retrieveOrder.
+        """
+        if self.str_retrieveOrder == 'smallest':
+            return sorted(al_unit, key = lambda d_unit: d_unit['instances'])
+        if self.str_retrieveOrder == 'largest':
+            return sorted(al_unit, key = lambda d_unit: -d_unit['instances'])
+        if self.str_retrieveOrder == 'roundrobin':
+            d_study     = {}
+            for d_unit in al_unit:
+                d_study.setdefault(d_unit['study'], []).append(d_unit)
+            l_unit      = []
+            while len(d_study):
+                for study in list(d_study):
+                    l_unit.append(d_study[study].pop(0))
+                    if not len(d_study[study]): del d_study[study]
+            return l_unit
+        return list(al_unit)
+
+    def retrievePlan_admit(self, options, al_unit, al_pendingCall):
+        """
+        Start the next retrieve units of <al_unit> (removing them from it)
+        that fit in the self.maxInstancesInFlight budget, given the status
+        calls still pending in <al_pendingCall>. At least one unit is 
+        started if nothing is in flight. Return the status calls of the 
+        started units.
+
+        Units whose retrieve fails to initiate are not polled: their calls
+        are added to self.l_retrieveFailed, and their budget goes to the
+        next units.
+        """
+        def uids_get(d_unit):
+            return [d_call['meta']['on'].get('series_uid', '') for d_call in d_unit['calls']]
+
+        # Retrieves initiated by a prior run (see the journal), that have not
+        # yet timed out, are only polled
+        def initiated(str_seriesUID):
+            d_record    = self.journal.state_get(str_seriesUID)
+            return d_record.get('state') == 'initiated' and \
+                   (self.retrieveTimeout <= 0 or time.time() - d_record['time'] < self.retrieveTimeout)
+
+        l_ret       = []
+        while len(al_unit):
+            l_inFlight  = list(al_pendingCall) + l_ret
+            inFlight    = sum([self.seriesHits_instanceCount(d_call['meta']['on'].get('series_uid', ''))
+                                for d_call in l_inFlight])
+            l_admit     = []
+            while len(al_unit):
+                if  self.maxInstancesInFlight > 0 and (len(l_inFlight) or len(l_admit)) and \
+                    inFlight + al_unit[0]['instances'] > self.maxInstancesInFlight:
+                    break
+                inFlight   += al_unit[0]['instances']
+                l_admit.append(al_unit.pop(0))
+            if not len(l_admit):
+                break
+            if len(al_unit):
+                self.dp.qprint('Starting %d retrieves (%d instances in flight), %d waiting...' %
+                                (len(l_admit), inFlight, len(al_unit)))
+
+            l_start     = [d_unit for d_unit in l_admit
+                            if not (self.journal and all([initiated(str_seriesUID)
+                                                          for str_seriesUID in uids_get(d_unit)]))]
+            l_init      = self.retrieve_initiate(options, msgList = [d_unit['msg'] for d_unit in l_start])
+            s_failed    = set()
+            for d_unit, d_init in zip(l_start, l_init):
+                if 'serviceCallError' in d_init:
+                    self.dp.qprint('Retrieve of %s failed to initiate: %s' %
+                                    (d_unit['msg']['meta']['on'], d_init['serviceCallError']),
+                                    comms = 'error')
+                    s_failed.add(id(d_unit))
+                    self.l_retrieveFailed.extend(d_unit['calls'])
+                    continue
+                for str_seriesUID in uids_get(d_unit):
+                    self.journal_record(str_seriesUID, 'initiated')
+            l_ret      += [dict(d_call, meta = dict(d_call['meta'], do = 'retrieveStatus'))
+                            for d_unit in l_admit if id(d_unit) not in s_failed
+                            for d_call in d_unit['calls']]
+            if not len(s_failed):
+                break
         return l_ret
 
-    def retrieve_resultsCopy(self, ald_msg):
+    def retrieve_initiate(self, options, *args, **kwargs):
         """
-        Call the pfdcm service to copy outputs from its internal unpack location
-        to the output dir of this script.
+        Initiate the actual retrieve calls to the PACS of interest.
 
-        PRECONDITIONS
-        * The filesystem of this script and that of pfdcm are logically the same.
+        The retrieve messages are the <msgList> passed, or else the 
+        per series self.l_dmsg.
         """
-        l_ret = []
+        l_ret   = []
+        l_msg   = self.l_dmsg
+        for k, v in kwargs.items():
+            if k == 'msgList':  l_msg   = v
 
         if self.b_canRun:
-            for self.d_msg in ald_msg:
-                self.dp.qprint('Messaging the dcm service to pull retrieved DICOM data...')
-                l_ret.append(self.service_call(msg = self.d_msg))
+            l_ret   = self.serviceCall_batch(
+                        l_msg,
+                        workers = self.maxConcurrentRetrieves,
+                        note    = 'Messaging the dcm service to initiate a PACS retrieve...'
+                    )
+            l_failed    = [d for d in l_ret if 'serviceCallError' in d]
+            self.dp.qprint('Retrieve initiated for %d of %d messages.' %
+                            (len(l_ret) - len(l_failed), len(l_ret)))
         return l_ret
 
-    def jpgPreview_generate(self, *args, **kwargs):
+    def previewPool_get(self):
         """
-        Generate a jpg preview of the DICOMS in a list of directories
-        containing DICOM data.
+        Return the pool of preview worker processes, creating it on first
+        use. Return None if previews are to be generated in-process.
         """
-        lstr_DICOMdirs  = []
-        b_status        = False
-        d_ret           = {}
+        if self.previewWorkers == 1: return None
+        with self.lock_previewPool:
+            if not self.previewPool:
+                # 'spawn' since the pool is typically created from within
+                # the (multi-threaded) retrieve pipeline
+                self.previewPool    = concurrent.futures.ProcessPoolExecutor(
+                                        max_workers = self.previewWorkers or os.cpu_count(),
+                                        mp_context  = multiprocessing.get_context('spawn')
+                                    )
+        return self.previewPool
+
+    def previewJobs_run(self, fn_job, l_args):
+        """
+        Run <fn_job> over the argument tuples in <l_args>, in the preview
+        worker pool if there is one, and return the list of results.
+        """
+        pool    = self.previewPool_get()
+        if not pool:
+            return [fn_job(*args) for args in l_args]
+        l_future    = [pool.submit(fn_job, *args) for args in l_args]
+        return [future.result() for future in l_future]
 
-        for k,v in kwargs.items():
-            if k == 'l_DICOMdirs':    lstr_DICOMdirs    = v
-
-        for str_DICOMdir in lstr_DICOMdirs:
-            self.dp.qprint('In directory %s...' % str_DICOMdir)
-            # create a jpg subdir
-            str_jpgDir  = os.path.join(str_DICOMdir, 'jpg')
-            os.makedirs(str_jpgDir)
-            self.dp.qprint('Creating jpg dir %s...' % str_jpgDir)
-
-            # Loop over every DICOM to create a JPG
-            # pudb.set_trace()
-            os.chdir(str_DICOMdir)
-            l_lsDCM     = glob.glob('*.dcm')
-            self.dp.qprint('Generating raw jpg from %d DICOM files...' % len(l_lsDCM))
-            for str_FQfile in l_lsDCM:
-                str_file, str_ext = os.path.splitext(str_FQfile)
-                if str_ext == '.dcm':
-                    str_inputDICOMfile  = os.path.join(str_DICOMdir, str_FQfile)
-                    str_outputJPGfile   = os.path.join(str_jpgDir, str_file) 
-
-                    # Convert to jpg
-                    str_cmd = '/usr/bin/dcmj2pnm +oj +Wh 15 +Fa ' + str_inputDICOMfile + \
-                                ' ' + str_outputJPGfile
-                    str_response = subprocess.run(  str_cmd, 
+    def previewJobs_iter(self, fn_job, l_args):
+        """
+        Like previewJobs_run(), but yield the results one by one, in order,
+        while keeping only a small window of jobs in flight. This bounds 
+        the number of results held in memory at any time.
+        """
+        pool    = self.previewPool_get()
+        if not pool:
+            for args in l_args: yield fn_job(*args)
+            return
+        window      = 4 * (self.previewWorkers or os.cpu_count())
+        l_future    = []
+        for args in l_args:
+            l_future.append(pool.submit(fn_job, *args))
+            if len(l_future) >= window:
+                yield l_future.pop(0).result()
+        while len(l_future):
+            yield l_future.pop(0).result()
+
+    def previewEngine_get(self):
+        """
+        Return the preview engine to use, falling back to 'dcmtk' if the
+        'native' engine is requested but its dependencies are missing.
+        """
+        if self.str_previewEngine == 'native' and not pydicom:
+            self.dp.qprint('pydicom/NumPy/Pillow not available, using the dcmtk preview engine.',
+                            comms = 'error')
+            self.str_previewEngine  = 'dcmtk'
+        return self.str_previewEngine
+
+    def previewLayout_get(self, tiles):
+        """
+        Return the (columns, rows) grid of the preview for <tiles> tiles.
+        """
+        if self.str_previewLayout == 'mosaic' and tiles:
+            columns = max(1, min(self.previewColumns, tiles))
+            return columns, -(-tiles // columns)
+        return 1, tiles
+
+    def jpgPreview_tilePaste(self, preview, columns, index, tile):
+        """
+        Paste a (mode, bytes) thumbnail <tile> into the <index> cell of the
+        <preview> image, which is <columns> tiles wide.
+        """
+        size            = self.previewSize
+        str_mode, data  = tile
+        preview.paste(  Image.frombytes(str_mode, (size, size), data).convert('RGB'),
+                        ((index % columns) * size, (index // columns) * size))
+
+    def previewFiles_order(self, al_DICOMfile, d_manifest):
+        """
+        Return <al_DICOMfile> in InstanceNumber order or, if the InstanceNumber
+        of some file cannot be read, in file name order.
+
+        The InstanceNumbers are kept in the 'instances' of the preview
+        <d_manifest>, so that only the headers of new or changed files are 
+        read.
+        """
+        d_instances = {}
+        l_unknown   = []
+        for str_file in al_DICOMfile:
+            st          = os.stat(str_file)
+            d_source    = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            d_prior     = d_manifest['instances'].get(os.path.basename(str_file), {})
+            if d_prior.get('instance') is not None and \
+               all([d_prior.get(k) == v for k, v in d_source.items()]):
+                d_source['instance']    = d_prior['instance']
+            else:
+                l_unknown.append(str_file)
+            d_instances[os.path.basename(str_file)] = d_source
+        l_instance  = self.previewJobs_run(dicomInstanceNumber_read, [(f,) for f in l_unknown])
+        for str_file, instance in zip(l_unknown, l_instance):
+            d_instances[os.path.basename(str_file)]['instance'] = instance
+        d_manifest['instances'] = d_instances
+        if None in [d['instance'] for d in d_instances.values()]:
+            return sorted(al_DICOMfile)
+        return sorted(al_DICOMfile, key = lambda f: (d_instances[os.path.basename(f)]['instance'], f))
+
+    def previewSamples_select(self, al_DICOMfile, **kwargs):
+        """
+        Return <samples> (default self.previewSamples) files, evenly spaced
+        over <al_DICOMfile>, which is in InstanceNumber order (see 
+        previewFiles_order()).
+        """
+        samples     = self.previewSamples
+        for k, v in kwargs.items():
+            if k == 'samples':  samples     = v
+        l_ordered   = list(al_DICOMfile)
+        if samples == 1:
+            return [l_ordered[len(l_ordered) // 2]]
+        l_index     = [round(i * (len(l_ordered) - 1) / (samples - 1)) for i in range(samples)]
+        return [l_ordered[i] for i in sorted(set(l_index))]
+
+    def previewManifest_read(self, str_jpgDir):
+        """
+        Read the preview manifest of a jpg dir, which records the size and
+        mtime of the source DICOM file of each thumbnail, and a signature
+        of the inputs of the last 'preview.jpg'.
+        """
+        d_manifest  = {'files': {}, 'instances': {}, 'preview': ''}
+        try:
+            with open(os.path.join(str_jpgDir, self.str_previewManifest)) as f:
+                d_manifest.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return d_manifest
+
+    def previewManifest_write(self, str_jpgDir, d_manifest):
+        """
+        Atomically (re)write the preview manifest of a jpg dir.
+        """
+        str_manifest    = os.path.join(str_jpgDir, self.str_previewManifest)
+        with open(str_manifest + '.tmp', 'w') as f:
+            json.dump(d_manifest, f)
+        os.replace(str_manifest + '.tmp', str_manifest)
+
+    def previewThumbnail_find(self, str_out):
+        """
+        Return the thumbnail file written for the output name <str_out>
+        (dcmtk may add a suffix, e.g. per frame), or '' if there is none.
+        """
+        if os.path.exists(str_out): return str_out
+        l_jpgFile   = sorted(glob.glob(glob.escape(str_out) + '.*'))
+        return l_jpgFile[0] if len(l_jpgFile) else ''
+
+    def previewThumbnail_load(self, str_out):
+        """
+        Return the (mode, bytes) tile of the thumbnail for <str_out> on
+        disk, or None.
+        """
+        str_jpgFile = self.previewThumbnail_find(str_out)
+        if not str_jpgFile: return None
+        try:
+            with Image.open(str_jpgFile) as image:
+                image   = image.convert('RGB').resize((self.previewSize, self.previewSize))
+                return (image.mode, image.tobytes())
+        except Exception:
+            return None
+
+    def jpgPreview_generateForDir(self, str_DICOMdir):
+        """
+        Generate a jpg preview of the DICOMS in a single directory.
+
+        The per-file work is spread over the preview worker pool. With the
+        'native' engine, each file is rendered straight into a thumbnail 
+        and the preview is composed in memory; files that it cannot decode,
+        and all files with the 'dcmtk' engine, are converted to jpg by
+        'dcmj2pnm' and resized by (batched) 'mogrify' calls. Note that this
+        does not change the working directory, and so is safe to call from
+        the retrieve pipeline threads.
+
+        Generation is incremental: a manifest in the jpg dir records the
+        size and mtime of the source of every thumbnail, so that only new
+        or changed DICOM files are converted, and 'preview.jpg' is only
+        rebuilt if its inputs have changed.
+
+        Return a dictionary that includes the time spent on each step.
+        """
+        d_time      = {}
+        startTime   = time.time()
+        str_engine  = self.previewEngine_get()
+        self.dp.qprint('In directory %s...' % str_DICOMdir)
+        # create a jpg subdir
+        str_jpgDir  = os.path.join(str_DICOMdir, 'jpg')
+        os.makedirs(str_jpgDir, exist_ok = True)
+        self.dp.qprint('Creating jpg dir %s...' % str_jpgDir)
+        d_manifest  = self.previewManifest_read(str_jpgDir)
+        d_files     = {}
+
+        # Select the DICOMs to preview, and find which of these are new or
+        # changed since the last run
+        # pudb.set_trace()
+        d_instances = d_manifest['instances']
+        l_lsDCM     = self.previewFiles_order(glob.glob(os.path.join(str_DICOMdir, '*.dcm')),
+                                              d_manifest)
+        if self.previewSamples > 0 and len(l_lsDCM) > self.previewSamples:
+            l_lsDCM = self.previewSamples_select(l_lsDCM)
+        if self.previewMaxTiles > 0 and len(l_lsDCM) > self.previewMaxTiles:
+            l_lsDCM = self.previewSamples_select(l_lsDCM, samples = self.previewMaxTiles)
+        l_convert   = []
+        l_changed   = []
+        for str_inputDICOMfile in l_lsDCM:
+            str_file, str_ext = os.path.splitext(os.path.basename(str_inputDICOMfile))
+            str_out         = os.path.join(str_jpgDir, str_file)
+            st              = os.stat(str_inputDICOMfile)
+            d_source        = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            d_files[os.path.basename(str_inputDICOMfile)]   = d_source
+            l_convert.append((str_inputDICOMfile, str_out))
+            if d_manifest['files'].get(os.path.basename(str_inputDICOMfile)) != d_source or \
+               not self.previewThumbnail_find(str_out):
+                l_changed.append((str_inputDICOMfile, str_out))
+
+        # Thumbnails of DICOMs that are no longer previewed are removed, so
+        # that they do not end up in the preview
+        s_out       = set([str_out for str_in, str_out in l_convert])
+        for str_jpgFile in glob.glob(os.path.join(str_jpgDir, '*')):
+            str_stem    = str_jpgFile
+            while str_stem not in s_out and '.' in os.path.basename(str_stem):
+                str_stem    = os.path.splitext(str_stem)[0]
+            if str_stem not in s_out:
+                os.remove(str_jpgFile)
+
+        str_previewFile     = os.path.join(str_DICOMdir, 'preview.jpg')
+        str_signature       = hashlib.sha1(json.dumps([
+                                sorted(d_files.items()), str_engine, self.str_previewLayout,
+                                self.previewColumns, self.previewSize], 
+                                sort_keys = True).encode()).hexdigest()
+        if not len(l_changed) and d_manifest['preview'] == str_signature and \
+           os.path.exists(str_previewFile):
+            self.dp.qprint('Preview of %s is up to date.' % str_DICOMdir)
+            if d_manifest['instances'] != d_instances:
+                self.previewManifest_write(str_jpgDir, d_manifest)
+            return {
+                'status':   True,
+                'engine':   str_engine,
+                'files':    len(l_lsDCM),
+                'changed':  0,
+                'time':     {'total': time.time() - startTime}
+            }
+        self.dp.qprint('Generating %s jpg from %d new or changed of %d DICOM files...' % 
+                        (str_engine, len(l_changed), len(l_lsDCM)))
+
+        # The native engine streams each tile into the preview as soon as
+        # it is rendered (or read back, if unchanged), so only the preview 
+        # itself is held in memory
+        s_native    = set()
+        s_changed   = set([str_out for str_in, str_out in l_changed])
+        if str_engine == 'native':
+            columns, rows   = self.previewLayout_get(len(l_convert))
+            preview         = Image.new('RGB', (columns * self.previewSize, rows * self.previewSize))
+            it_rendered     = self.previewJobs_iter(dicomThumbnail_render, l_changed)
+            for index, (str_in, str_out) in enumerate(l_convert):
+                if str_out in s_changed:
+                    tile    = next(it_rendered)
+                else:
+                    tile    = self.previewThumbnail_load(str_out)
+                if tile:
+                    self.jpgPreview_tilePaste(preview, columns, index, tile)
+                    s_native.add(str_out)
+        l_dcmtk     = [args for args in l_changed if args[1] not in s_native]
+        if len(s_native) and len(l_dcmtk):
+            self.dp.qprint('%d files could not be decoded in-process, using dcmtk for these...' %
+                            len(l_dcmtk))
+        self.previewJobs_run(dcm2jpg_convert, l_dcmtk)
+        d_time['convert']   = time.time() - startTime
+
+        # Resize the new dcmtk JPGs, in batches spread over the workers
+        # pudb.set_trace()
+        l_lsjpg     = [self.previewThumbnail_find(str_out) for str_in, str_out in l_dcmtk]
+        l_lsjpg     = [str_jpgFile for str_jpgFile in l_lsjpg if str_jpgFile]
+        self.dp.qprint('Resizing %d jpg images...' % len(l_lsjpg))
+        workers     = 1 if self.previewWorkers == 1 else (self.previewWorkers or os.cpu_count())
+        batchSize   = min(  self.mogrifyBatchMax,
+                            max(1, -(-len(l_lsjpg) // workers)))
+        self.previewJobs_run(jpg_resize, [(l_lsjpg[i:i + batchSize],) 
+                                          for i in range(0, len(l_lsjpg), batchSize)])
+        d_time['resize']    = time.time() - startTime - d_time['convert']
+
+        # Now create a preview
+        # pudb.set_trace()
+        self.dp.qprint('Appending all jpgs into a %s preview...' % self.str_previewLayout)
+        if str_engine == 'native':
+            # Fill the cells of files that fell back to the dcmtk engine from
+            # what it wrote to disk
+            for index, (str_in, str_out) in enumerate(l_convert):
+                if str_out in s_native: continue
+                tile    = self.previewThumbnail_load(str_out)
+                if tile:
+                    self.jpgPreview_tilePaste(preview, columns, index, tile)
+                    s_native.add(str_out)
+            b_status    = len(s_native) > 0
+            if b_status: preview.save(str_previewFile, 'JPEG')
+        else:
+            # Tiles are appended in InstanceNumber order, not in the order of
+            # the jpg dir listing
+            l_jpgFile   = []
+            for str_in, str_out in l_convert:
+                l_jpgFile  += [str_out] if os.path.exists(str_out) else \
+                              sorted(glob.glob(glob.escape(str_out) + '.*'))
+            if self.str_previewLayout == 'mosaic':
+                l_cmd   = ['/usr/bin/montage', '-mode', 'concatenate', 
+                           '-tile', '%dx' % self.previewColumns]
+            else:
+                l_cmd   = ['/usr/bin/convert', '-append']
+            try:
+                str_response    = subprocess.run(   l_cmd + l_jpgFile + [str_previewFile], 
                                                     stdout = subprocess.PIPE,
-                                                    stderr = subprocess.STDOUT,
-                                                    shell  = True
+                                                    stderr = subprocess.STDOUT
                                                 )
+                b_status        = len(l_jpgFile) > 0 and str_response.returncode == 0
+            except OSError:
+                b_status        = False
+
+        # Only record the sources whose thumbnails were actually written
+        d_manifest['files']     = dict([(os.path.basename(str_in), d_files[os.path.basename(str_in)])
+                                        for str_in, str_out in l_convert
+                                        if self.previewThumbnail_find(str_out)])
+        d_manifest['preview']   = str_signature if b_status else ''
+        self.previewManifest_write(str_jpgDir, d_manifest)
+
+        d_time['append']    = time.time() - startTime - d_time['convert'] - d_time['resize']
+        d_time['total']     = time.time() - startTime
+        self.dp.qprint('Preview of %s (%d files): convert %.2fs, resize %.2fs, append %.2fs, total %.2fs' %
+                        (str_DICOMdir, len(l_lsDCM), d_time['convert'], d_time['resize'],
+                         d_time['append'], d_time['total']))
+        return {
+            'status':   b_status,
+            'engine':   str_engine,
+            'files':    len(l_lsDCM),
+            'changed':  len(l_changed),
+            'time':     d_time
+        }
 
-            # Loop over every JPG to resize
-            # pudb.set_trace()
-            l_lsjpg     = os.listdir(str_jpgDir)
-            self.dp.qprint('Resizing %d jpg images...' % len(l_lsjpg))
-            for str_FQfile  in l_lsjpg:
-                str_cmd = '/usr/bin/mogrify -resize 96x96 -background none -gravity center -extent 96x96 ' + \
-                            os.path.join(str_jpgDir, str_FQfile)
-                str_response = subprocess.run(  str_cmd, 
-                                                stdout = subprocess.PIPE,
-                                                stderr = subprocess.STDOUT,
-                                                shell  = True
-                                            )
-            # Now create a preview
-            # pudb.set_trace()
-            self.dp.qprint('Appending all jpgs into a preview...')
-            str_cmd = '/usr/bin/convert -append ' + os.path.join(str_jpgDir,   '*') + ' ' + \
-                                                    os.path.join(str_DICOMdir, 'preview.jpg')                                 
-            str_response = subprocess.run(  str_cmd, 
-                                            stdout = subprocess.PIPE,
-                                            stderr = subprocess.STDOUT,
-                                            shell  = True
-                                        )
+    def seriesBatch_finish(self, al_done):
+        """
+        The tail of the retrieve pipeline for a batch of series that are
+        done on the service side: determine their local paths, pull them
+        to the output dir and, if requested, generate the jpg previews of
+        those that were pulled.
 
-    def retrieve_run(self, options):
+        Return a list of per-series dictionaries. A failure on one series
+        is recorded in its dictionary and does not affect the others.
         """
-        Run a retrieve
+        l_ret       = []
+        l_copy      = self.retrieveMessageCopy_construct(al_done)
+        if self.str_pullMode == 'local':
+            l_pull  = [self.seriesPull_local(d_copy['seriesUID'], d_copy['path'])
+                        for d_copy in l_copy]
+        else:
+            l_pull  = self.serviceCall_batch(
+                        [d_copy['msg'] for d_copy in l_copy],
+                        note    = 'Messaging the dcm service to pull retrieved DICOM data...'
+                    )
+        for d_copy, d_pull in zip(l_copy, l_pull):
+            d_series    = {
+                'seriesUID':    d_copy['seriesUID'],
+                'path':         d_copy['path'],
+                'pull':         d_pull,
+                'preview':      {}
+            }
+            if d_pull.get('status'):
+                l_file  = self.seriesPull_files(d_copy['path'])
+                self.journal_record(d_copy['seriesUID'], 'pulled', 
+                                    path    = d_copy['path'],
+                                    files   = len(l_file))
+                self.cache_insert(d_copy['seriesUID'], l_file)
+                d_series    = self.seriesPreview_finish(d_series)
+            l_ret.append(d_series)
+        return l_ret
+
+    def seriesPreview_finish(self, d_series):
+        """
+        If requested, generate the jpg preview of the pulled <d_series>,
+        and return it.
+        """
+        if self.options.b_jpgPreview:
+            try:
+                d_series['preview'] = self.jpgPreview_generateForDir(d_series['path'])
+                if d_series['preview'].get('status'):
+                    self.journal_record(d_series['seriesUID'], 'previewed', path = d_series['path'])
+            except Exception as e:
+                self.dp.qprint('Preview of %s failed: %s' % (d_series['path'], e),
+                                comms = 'error')
+                d_series['preview'] = {'status': False, 'error': '%s' % e}
+        return d_series
+
+    def smdbDir_check(self):
         """
+        Return an error if self.str_smdbDir is not the log dir of an smdb,
+        else ''. Opening an smdb creates any of its dirs that are missing,
+        so these are checked first, without creating anything.
+        """
+        l_dir       = [ os.path.join(self.str_smdbDir, str_dir)
+                        for str_dir in ['patientData', 'studyData', 'seriesData']]
+        l_dir      += [ os.path.join(self.str_smdbDir, '..', str_dir)
+                        for str_dir in ['data', 'services']]
+        for str_dir in [self.str_smdbDir] + l_dir:
+            if not os.path.isdir(str_dir):
+                return '%s is not an smdb log dir (no dir %s)' % (self.str_smdbDir, os.path.normpath(str_dir))
+        return ''
+
+    def seriesUnpackDir_get(self, str_seriesUID):
+        """
+        Look up the dir that the service unpacked <str_seriesUID> to, in 
+        its smdb. Return a dictionary with the 'status' and 'path', and an
+        'error' if the lookup failed.
+        """
+        d_ret       = {'status': False, 'path': '', 'error': ''}
+        try:
+            with self.lock_smdb:
+                if not self.smdb:
+                    if not smdb:
+                        d_ret['error']  = 'pypx has no smdb'
+                        return d_ret
+                    d_ret['error']      = self.smdbDir_check()
+                    if len(d_ret['error']):
+                        return d_ret
+                    self.smdb   = smdb.SMDB(argparse.Namespace( str_logDir  = self.str_smdbDir,
+                                                                b_debug     = False,
+                                                                verbosity   = 0))
+            d_dir           = self.smdb.imageDirs_getOnSeriesInstanceUID(str_seriesUID)
+            d_ret['status'] = d_dir['status'] and os.path.isdir(d_dir[str_seriesUID])
+            d_ret['path']   = d_dir[str_seriesUID]
+            d_ret['error']  = d_dir['error'] or ('' if d_ret['status'] else
+                                                 'no unpack dir %s' % d_ret['path'])
+        except Exception as e:
+            d_ret['status'] = False
+            d_ret['error']  = '%s' % e
+        return d_ret
 
-        # First, construct an internal list of message base dictionaries
-        self.queryTable_read(priorHitsTable = options.str_priorHitsTable)
-        self.retrieveMessage_checkAndConstructBase(options)
+    def seriesPull_local(self, str_seriesUID, str_path):
+        """
+        Pull a retrieved series to <str_path> directly from the dir that
+        the service unpacked it to, the files in parallel on the shared 
+        self.pullWorkers threads. Files are hard linked where both dirs are
+        on the same filesystem, and else copied in the kernel.
+
+        Return a dictionary with the 'status', the number of 'files' and
+        'bytes' pulled, when it 'started', the 'time' taken and the
+        'throughput' (in MB/s), and the link/copy 'methods' used.
+        """
+        startTime   = time.time()
+        d_ret       = {'status': False, 'files': 0, 'bytes': 0, 'methods': {}, 'started': startTime}
+        d_dir       = self.seriesUnpackDir_get(str_seriesUID)
+        d_ret['source']     = d_dir['path']
+        if not d_dir['status']:
+            d_ret['error']  = d_dir['error']
+            return d_ret
+        os.makedirs(str_path, exist_ok = True)
+        b_link      = os.stat(d_dir['path']).st_dev == os.stat(str_path).st_dev
+
+        def file_pull(str_name):
+            str_source  = os.path.join(d_dir['path'], str_name)
+            str_target  = os.path.join(str_path, str_name)
+            if os.path.exists(str_target):
+                os.remove(str_target)
+            if b_link:
+                try:
+                    os.link(str_source, str_target)
+                    return 'hardlink', os.path.getsize(str_source)
+                except OSError:
+                    pass
+            return 'copy', file_copy(str_source, str_target)
+
+        with self.lock_smdb:
+            if not self.pullPool:
+                self.pullPool   = concurrent.futures.ThreadPoolExecutor(
+                                        max_workers = max(1, self.pullWorkers))
+        l_name      = [str_name for str_name in os.listdir(d_dir['path']) 
+                        if os.path.isfile(os.path.join(d_dir['path'], str_name))]
+        try:
+            for str_method, size in self.pullPool.map(file_pull, l_name):
+                d_ret['methods'][str_method]    = d_ret['methods'].get(str_method, 0) + 1
+                d_ret['files']  += 1
+                d_ret['bytes']  += size
+            d_ret['status']     = True
+        except Exception as e:
+            d_ret['error']      = '%s' % e
+        d_ret['time']       = time.time() - startTime
+        d_ret['throughput'] = d_ret['bytes'] / 1024**2 / max(d_ret['time'], 1e-6)
+        self.dp.qprint('Pulled %d files (%d bytes) of %s in %.2fs (%.1f MB/s)' % 
+                        (d_ret['files'], d_ret['bytes'], str_seriesUID, 
+                         d_ret['time'], d_ret['throughput']))
+        return d_ret
+
+    def seriesPull_files(self, str_path):
+        """
+        Return the list of DICOM files pulled to <str_path>.
+        """
+        return glob.glob(os.path.join(glob.escape(str_path), '*.dcm'))
+
+    def cache_insert(self, str_seriesUID, al_file):
+        """
+        Add the pulled files of a series to the shared cache, if there is
+        one and the series is complete.
+        """
+        expected    = self.seriesHits_instanceCount(str_seriesUID)
+        if self.cache and len(al_file) and (not expected or len(al_file) == expected):
+            try:
+                self.cache.series_insert(str_seriesUID, al_file)
+            except Exception as e:
+                self.dp.qprint('Caching of %s failed: %s' % (str_seriesUID, e), comms = 'error')
+
+    def cache_split(self, al_call):
+        """
+        Split the per series calls <al_call> on the shared cache: return
+        the calls of the series that are not (fully) cached, and those of
+        the series that are. The latter are pinned in the cache, until
+        seriesCached_materialize().
+        """
+        l_call      = []
+        l_cached    = []
+        for d_call in al_call:
+            str_seriesUID   = d_call['meta']['on'].get('series_uid', '')
+            d_manifest      = self.cache.series_lookup(str_seriesUID) if self.cache else None
+            expected        = self.seriesHits_instanceCount(str_seriesUID)
+            if d_manifest and (not expected or len(d_manifest['files']) == expected):
+                self.cache.series_pin(str_seriesUID)
+                l_cached.append(d_call)
+            else:
+                l_call.append(d_call)
+        if len(l_cached):
+            self.dp.qprint('%d series found in the cache.' % len(l_cached))
+        return l_call, l_cached
+
+    def seriesCached_materialize(self, str_seriesUID):
+        """
+        Link the files of a cached series from the cache into its local
+        path, and unpin it. Return the series dictionary, with a False
+        pull 'status' if the series is no longer (fully) in the cache.
+        """
+        str_path    = self.retrieveMessageCopy_construct(
+                            [{'retrieveStatus': {'seriesUID': str_seriesUID}}])[0]['path']
+        startTime   = time.time()
+        try:
+            d_pull  = self.cache.series_materialize(str_seriesUID, str_path)
+        except Exception as e:
+            d_pull  = {'status': False, 'error': '%s' % e}
+        finally:
+            self.cache.series_unpin(str_seriesUID)
+        d_pull['cached']    = True
+        d_pull['time']      = time.time() - startTime
+        d_series    = {
+            'seriesUID':    str_seriesUID,
+            'path':         str_path,
+            'pull':         d_pull,
+            'preview':      {}
+        }
+        if d_pull['status']:
+            self.journal_record(str_seriesUID, 'pulled', path = str_path, files = d_pull['files'])
+        return d_series
 
-        # Now, check if a given seriesUID already exists in the series_map, possibly
-        # from some prior call...
-        self.baseMessage_set(do = 'retrieveStatus')
-        d_retStatus = self.retrieveStatus_process(self.l_dmsg, waitForPending = False)
-        if d_retStatus['status']:
-            self.l_dmsg = list(d_retStatus['pendingCalls'])
-            self.baseMessage_set(do = 'retrieve')
+    def journal_record(self, str_seriesUID, str_state, **kwargs):
+        """
+        Record the <str_state> of a series in the journal, if there is one.
+        """
+        if self.journal:
+            self.journal.record(str_seriesUID, str_state, **kwargs)
+
+    def journal_resume(self, al_call):
+        """
+        Split the per series calls <al_call> on the journal of a prior
+        run: series that were pulled, and whose pull dir holds the 
+        expected number of DICOM files (NumberOfSeriesRelatedInstances,
+        or else the number of files recorded at the pull), are resumed.
+
+        Return the calls still to be run, and the per series dictionaries
+        of the resumed series (with the 'state' they were left in).
+        """
+        l_call      = []
+        l_resumed   = []
+        for d_call in al_call:
+            str_seriesUID   = d_call['meta']['on'].get('series_uid', '')
+            d_record        = self.journal.state_get(str_seriesUID) if self.journal else {}
+            str_path        = d_record.get('path', '')
+            if d_record.get('state') in ['pulled', 'previewed'] and os.path.isdir(str_path):
+                expected    = self.seriesHits_instanceCount(str_seriesUID) or d_record.get('files', 0)
+                if expected and len(self.seriesPull_files(str_path)) == expected:
+                    l_resumed.append({
+                        'seriesUID':    str_seriesUID,
+                        'path':         str_path,
+                        'pull':         {'status': True, 'resumed': True},
+                        'preview':      {},
+                        'state':        d_record['state']
+                    })
+                    continue
+            l_call.append(d_call)
+        if len(l_resumed):
+            self.dp.qprint('Resuming %d series already pulled by a prior run.' % len(l_resumed))
+        return l_call, l_resumed
+
+    def seriesPipeline_submit(self, executor, al_done):
+        """
+        Submit a list of done retrieves to the pipeline <executor>, each
+        series on its own, and return the list of futures.
+        """
+        return [executor.submit(self.seriesBatch_finish, [d_done]) for d_done in al_done]
 
-        # Start the set of pending retrieves...
-        l_init  = self.retrieve_initiate(options)
+    def retrieve_run(self, options):
+        """
+        Run a retrieve
 
-        # Check/block on the status...
-        self.retrieveMessageStatus_checkAndConstruct()
-        l_check = self.retrieveStatus_process(self.l_dmsg, waitForPending = True)
+        The retrieve runs as a per-series pipeline: as soon as a status
+        check reports a series as done, that series is pulled to the output
+        dir (and previewed) by one of self.pipelineWorkers threads while the
+        other series are still in flight.
+        """
+        d_ret       = {
+            'status':   False,
+            'series':   [],
+            'timedOut': [],
+            'failed':   []
+        }
+        l_future    = []
+        self.l_retrieveFailed   = []
 
-        # PULL the results to the output dir
-        self.retrieveMessageCopy_checkAndConstruct()
-        l_copy  = self.retrieve_resultsCopy(self.l_dmsg)
+        # First, construct an internal list of message base dictionaries
+        self.l_indexList    = self.indexList_parse(options.str_indexList)
+        self.queryTable_read(   priorHitsTable  = options.str_priorHitsTable,
+                                priorHitsDB     = options.str_priorHitsDB,
+                                select          = options.str_select,
+                                indexList       = [int(series) for series in self.l_indexList])
+        self.retrieveMessage_checkAndConstructBase(options)
 
-        # If specified, generate a jpg preview
-        if options.b_jpgPreview:
-            self.jpgPreview_generate(l_DICOMdirs = self.lstr_outputPull)
+        # Resume from the journal of a prior run in the output dir, if any
+        l_resumed   = []
+        if len(self.str_journal):
+            self.journal            = RetrieveJournal(os.path.join(self.str_outputDir, self.str_journal))
+            self.l_dmsg, l_resumed  = self.journal_resume(self.l_dmsg)
+
+        # ... and take the series in the shared cache from there
+        l_cached    = []
+        if len(self.str_cacheDir):
+            self.cache              = DICOMCache(   self.str_cacheDir,
+                                                    maxBytes = int(self.cacheMaxGB * 1024**3))
+            self.l_dmsg, l_cached   = self.cache_split(self.l_dmsg)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers = max(1, self.pipelineWorkers)) as executor:
+
+            def done_process(al_done):
+                for d_done in al_done:
+                    self.journal_record(d_done['retrieveStatus']['seriesUID'], 'received')
+                l_future.extend(self.seriesPipeline_submit(executor, al_done))
+
+            # Series pulled by a prior run are done, save for their previews...
+            for d_series in l_resumed:
+                if options.b_jpgPreview and d_series['state'] != 'previewed':
+                    l_future.append(executor.submit(lambda d: [self.seriesPreview_finish(d)], d_series))
+                else:
+                    d_ret['series'].append(d_series)
+
+            # ... and cached series are materialized before any retrieve is
+            # started, so that those that fail to are retrieved instead
+            l_materialized  = list(executor.map(self.seriesCached_materialize,
+                                                [d_call['meta']['on'].get('series_uid', '')
+                                                    for d_call in l_cached]))
+            for d_call, d_series in zip(l_cached, l_materialized):
+                if d_series['pull']['status']:
+                    l_future.append(executor.submit(lambda d: [self.seriesPreview_finish(d)], d_series))
+                else:
+                    self.dp.qprint('Series %s could not be taken from the cache, retrieving it.' %
+                                    d_series['seriesUID'], comms = 'error')
+                    self.l_dmsg.append(d_call)
+
+            # Now, check if a given seriesUID already exists in the series_map, possibly
+            # from some prior call -- these go straight to the pipeline...
+            self.baseMessage_set(do = 'retrieveStatus')
+            d_retStatus = self.retrieveStatus_process(  self.l_dmsg, 
+                                                        waitForPending  = False,
+                                                        onDone          = done_process)
+            if d_retStatus['status']:
+                self.l_dmsg = list(d_retStatus['pendingCalls'])
+
+                # Start the pending retrieves (study by study where possible) in
+                # order, as the budget of instances in flight allows...
+                l_unit  = self.retrievePlan_order(self.retrievePlan_build(self.l_dmsg))
+                def admit(al_pendingCall):
+                    return self.retrievePlan_admit(options, l_unit, al_pendingCall)
+
+                # Check/block on the status, feeding the pipeline as we go...
+                d_check = self.retrieveStatus_process(  admit([]), 
+                                                        waitForPending  = True,
+                                                        onDone          = done_process,
+                                                        admit           = admit)
+                d_ret['timedOut']   = [d['meta']['on'] for d in d_check['timedOutCalls']]
+                # ... and those not started within the timeout, by the budget
+                if len(l_unit):
+                    self.dp.qprint('Timed out with %d retrieves not yet started.' % len(l_unit),
+                                    comms = 'error')
+                    d_ret['timedOut']  += [d_call['meta']['on'] for d_unit in l_unit 
+                                                                for d_call in d_unit['calls']]
+                d_ret['failed']     = [d_call['meta']['on'] for d_call in self.l_retrieveFailed]
+
+            for future in l_future:
+                try:
+                    d_ret['series'].extend(future.result())
+                except Exception as e:
+                    self.dp.qprint('Retrieve pipeline error: %s' % e, comms = 'error')
+
+        if self.journal:
+            self.journal.close()
+            self.journal        = None
+        if self.pullPool:
+            self.pullPool.shutdown()
+            self.pullPool       = None
+        l_pull      = [d['pull'] for d in d_ret['series'] if 'throughput' in d['pull']]
+        if len(l_pull):
+            d_ret['pullBytes']  = sum([d['bytes'] for d in l_pull])
+            d_ret['pullTime']   = max([d['started'] + d['time'] for d in l_pull]) - \
+                                  min([d['started'] for d in l_pull])
+            self.dp.qprint('Pulled %d bytes of %d series in %.2fs (%.1f MB/s)' %
+                            (d_ret['pullBytes'], len(l_pull), d_ret['pullTime'],
+                             d_ret['pullBytes'] / 1024**2 / max(d_ret['pullTime'], 1e-6)))
+        self.lstr_outputPull    = [d['path'] for d in d_ret['series']]
+        d_ret['status']         = not len(d_ret['timedOut']) and not len(d_ret['failed']) and \
+                                  len(d_ret['series']) == len(self.l_indexList)
+        return d_ret
 
     def run(self, options):
         """
@@ -1148,6 +4384,31 @@ class PacsRetrieveApp(ChrisApp):
 
         self.b_pfurlQuiet           = options.b_pfurlQuiet
         self.b_serviceCallQuiet     = options.b_serviceCallQuiet
+        self.str_serviceTransport   = options.str_serviceTransport
+        self.str_jsonBackend        = options.str_jsonBackend
+        self.b_bulkMessages         = options.b_bulkMessages
+        self.b_studyRetrieve        = options.b_studyRetrieve
+        self.str_retrieveOrder      = options.str_retrieveOrder
+        self.maxInstancesInFlight   = options.maxInstancesInFlight
+        self.str_journal            = options.str_journal
+        self.str_cacheDir           = options.str_cacheDir
+        self.cacheMaxGB             = options.cacheMaxGB
+        self.str_pullMode           = options.str_pullMode
+        self.str_smdbDir            = options.str_smdbDir
+        self.pullWorkers            = options.pullWorkers
+        self.maxConcurrentRetrieves = options.maxConcurrentRetrieves
+        self.maxConcurrentStatusChecks  = options.maxConcurrentStatusChecks
+        self.pipelineWorkers        = options.pipelineWorkers
+        self.previewWorkers         = options.previewWorkers
+        self.str_previewEngine      = options.str_previewEngine
+        self.previewSamples         = options.previewSamples
+        self.str_previewLayout      = options.str_previewLayout
+        self.previewColumns         = options.previewColumns
+        self.previewMaxTiles        = options.previewMaxTiles
+        self.pollIntervalMin        = options.pollIntervalMin
+        self.pollIntervalMax        = options.pollIntervalMax
+        self.instancesPerSecond     = options.instancesPerSecond
+        self.retrieveTimeout        = options.retrieveTimeout
         self.str_outputDir          = options.outputdir
         self.str_inputDir           = options.inputdir
 
@@ -1155,6 +4416,8 @@ class PacsRetrieveApp(ChrisApp):
         self.str_seriesSummaryFile  = options.str_seriesSummaryFile
         self.str_studySummaryKeys   = options.str_studySummaryKeys
         self.str_studySummaryFile   = options.str_studySummaryFile
+        self.str_summaryFormat      = options.str_summaryFormat
+        self.options_check()
 
         if options.b_version:
             print(str_version)
@@ -1169,6 +4432,10 @@ class PacsRetrieveApp(ChrisApp):
                             d_ret = self.query_run(options)
                     if options.str_action == 'retrieve': 
                             d_ret = self.retrieve_run(options)
+                if self.servicePool:
+                    self.servicePool.close()
+                if self.previewPool:
+                    self.previewPool.shutdown()
         return d_ret
 
 class PacsRetrieveAppOld(ChrisApp):
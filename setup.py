@@ -19,7 +19,8 @@ setup(
       author_email     =   'rudolph.pienaar@gmail.com',
       url              =   'https://github.com/FNNDSC/pfmisc',
       packages         =   ['pacsretrieve'],
-      install_requires =   ['pudb', 'pfmisc', 'chrisapp', 'pfurl', 'pypx'],
+      install_requires =   ['pudb', 'pfmisc', 'chrisapp', 'pfurl', 'pypx>=3.12.6',
+                           'numpy', 'pydicom', 'Pillow'],
       test_suite       =   'nose.collector',
       tests_require    =   ['nose'],
       scripts          =   ['pacsretrieve/pacsretrieve.py'],
@@ -0,0 +1,94 @@
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pacsretrieve import pacsretrieve
+
+
+class DICOMCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.str_dir        = tempfile.mkdtemp()
+        self.str_cacheDir   = os.path.join(self.str_dir, 'cache')
+        self.str_pullDir    = os.path.join(self.str_dir, 'pulled')
+
+    def tearDown(self):
+        shutil.rmtree(self.str_dir)
+
+    def series_make(self, str_seriesUID, files = 4):
+        """
+        Make the pulled files of a series, named (as 'pfdcm' does) for
+        their SOPInstanceUID, and return their list.
+        """
+        str_path    = os.path.join(self.str_pullDir, str_seriesUID)
+        os.makedirs(str_path)
+        l_file      = []
+        for i in range(files):
+            str_file    = os.path.join(str_path, '%05d-%s.%d.dcm' % (i, str_seriesUID, i))
+            with open(str_file, 'wb') as f:
+                f.write(os.urandom(1024))
+            l_file.append(str_file)
+        return l_file
+
+    def test_insert_and_materialize(self):
+        cache       = pacsretrieve.DICOMCache(self.str_cacheDir)
+        l_file      = self.series_make('1.2.3')
+        cache.series_insert('1.2.3', l_file)
+        self.assertEqual(len(cache.series_lookup('1.2.3')['files']), 4)
+        # The pulled files are not made read only with the cached ones
+        for str_file in l_file:
+            self.assertTrue(os.stat(str_file).st_mode & stat.S_IWUSR)
+        str_path    = os.path.join(self.str_dir, 'out')
+        d_ret       = cache.series_materialize('1.2.3', str_path)
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(sorted(os.listdir(str_path)),
+                         sorted([os.path.basename(str_file) for str_file in l_file]))
+
+    def test_concurrent_inserts(self):
+        cache       = pacsretrieve.DICOMCache(self.str_cacheDir, maxBytes = 1024**3)
+        d_series    = dict([('1.2.%d' % i, self.series_make('1.2.%d' % i, files = 16))
+                            for i in range(32)])
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 16) as executor:
+            l_future    = [executor.submit(cache.series_insert, str_seriesUID, l_file)
+                            for str_seriesUID, l_file in d_series.items()]
+            for future in l_future:
+                future.result()
+        for str_seriesUID in d_series:
+            self.assertEqual(len(cache.series_lookup(str_seriesUID)['files']), 16)
+        self.assertEqual(os.listdir(cache.str_tmpDir), [])
+
+    @unittest.skipUnless(pacsretrieve.fcntl, 'needs file locks')
+    def test_stale_tmp_dir_removed(self):
+        cache       = pacsretrieve.DICOMCache(self.str_cacheDir)
+        str_live    = os.path.join(cache.str_tmpDir, 'live')
+        os.makedirs(os.path.join(cache.str_tmpDir, 'killed'))
+        os.makedirs(str_live)
+        fd_live     = cache.tmpDir_lock(str_live)
+        try:
+            with cache.lock(True):
+                cache.evict()
+            self.assertEqual(os.listdir(cache.str_tmpDir), ['live'])
+        finally:
+            os.close(fd_live)
+
+    def test_inserted_series_not_evicted(self):
+        cache       = pacsretrieve.DICOMCache(self.str_cacheDir, maxBytes = 1024)
+        cache.series_insert('1.2.3', self.series_make('1.2.3'))
+        cache.series_pin('1.2.3')
+        cache.series_insert('1.2.4', self.series_make('1.2.4'))
+        self.assertIsNotNone(cache.series_lookup('1.2.3'))
+        self.assertIsNotNone(cache.series_lookup('1.2.4'))
+        cache.series_unpin('1.2.3')
+        cache.series_insert('1.2.5', self.series_make('1.2.5'))
+        self.assertIsNone(cache.series_lookup('1.2.3'))
+        self.assertIsNone(cache.series_lookup('1.2.4'))
+        self.assertIsNotNone(cache.series_lookup('1.2.5'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import os
+import sys
+import argparse
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pacsretrieve import pacsretrieve
+
+
+def hit_make(**kwargs):
+    """
+    Return a hit in the layout returned by 'pfdcm'.
+    """
+    return dict([(key, {'label': key, 'tag': 0, 'value': value})
+                 for key, value in kwargs.items()])
+
+l_hits  = [
+    hit_make(Modality = 'MR', SeriesDescription = 'T1 AXIAL',  StudyDate = '20180105',
+             NumberOfSeriesRelatedInstances = '192', PatientID = '1'),
+    hit_make(Modality = 'MR', SeriesDescription = 'T2 FLAIR',  StudyDate = '20171231',
+             NumberOfSeriesRelatedInstances = '40',  PatientID = '1'),
+    hit_make(Modality = 'CT', SeriesDescription = 'HEAD',      StudyDate = '20180301',
+             NumberOfSeriesRelatedInstances = '8',   PatientID = '2'),
+    hit_make(Modality = 'US', SeriesDescription = 'Doppler "A"', StudyDate = '20190101',
+             NumberOfSeriesRelatedInstances = 'n/a', PatientID = '3'),
+    hit_make(Modality = 'MR', StudyDate = '20180105', PatientID = '4'),
+    hit_make(Modality = 'MR', SeriesDescription = 'T1 SAG', StudyDate = 20180110,
+             NumberOfSeriesRelatedInstances = 192, PatientID = 5),
+]
+
+
+class HitsSelectorGrammarTest(unittest.TestCase):
+
+    def tree(self, str_select):
+        tree    = pacsretrieve.HitsSelector(str_select).tree
+        return self.tree_simplify(tree)
+
+    def tree_simplify(self, tree):
+        if tree[0] == 'cmp':
+            literal = tree[3].pattern if tree[2] == '~' else tree[3]
+            return (tree[1], tree[2], literal)
+        return (tree[0],) + tuple([self.tree_simplify(node) for node in tree[1:]])
+
+    def test_term(self):
+        self.assertEqual(self.tree('Modality==MR'), ('Modality', '==', 'MR'))
+        self.assertEqual(self.tree(' StudyDate >= 20180101 '), ('StudyDate', '>=', '20180101'))
+        for str_op in pacsretrieve.HitsSelector.l_op:
+            self.assertEqual(self.tree('a%sb' % str_op), ('a', str_op, 'b'))
+
+    def test_quotes(self):
+        self.assertEqual(self.tree('SeriesDescription=="T1 AXIAL"'),
+                         ('SeriesDescription', '==', 'T1 AXIAL'))
+        self.assertEqual(self.tree("SeriesDescription=='a (b) and c'"),
+                         ('SeriesDescription', '==', 'a (b) and c'))
+        self.assertEqual(self.tree(r'SeriesDescription=="Doppler \"A\""'),
+                         ('SeriesDescription', '==', 'Doppler "A"'))
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertEqual(self.tree('a==1 or b==2 and c==3'),
+                         ('or', ('a', '==', '1'), ('and', ('b', '==', '2'), ('c', '==', '3'))))
+        self.assertEqual(self.tree('a==1 and b==2 or c==3'),
+                         ('or', ('and', ('a', '==', '1'), ('b', '==', '2')), ('c', '==', '3')))
+
+    def test_not_binds_tightest(self):
+        self.assertEqual(self.tree('not a==1 and b==2'),
+                         ('and', ('not', ('a', '==', '1')), ('b', '==', '2')))
+        self.assertEqual(self.tree('not not a==1'), ('not', ('not', ('a', '==', '1'))))
+
+    def test_parentheses(self):
+        self.assertEqual(self.tree('(a==1 or b==2) and c==3'),
+                         ('and', ('or', ('a', '==', '1'), ('b', '==', '2')), ('c', '==', '3')))
+        self.assertEqual(self.tree('not (a==1 or b==2)'),
+                         ('not', ('or', ('a', '==', '1'), ('b', '==', '2'))))
+
+    def test_left_associative(self):
+        self.assertEqual(self.tree('a==1 or b==2 or c==3'),
+                         ('or', ('or', ('a', '==', '1'), ('b', '==', '2')), ('c', '==', '3')))
+
+    def test_keywords_case_insensitive(self):
+        self.assertEqual(self.tree('a==1 AND NOT b==2 Or c==3'),
+                         ('or', ('and', ('a', '==', '1'), ('not', ('b', '==', '2'))), ('c', '==', '3')))
+
+    def test_keys(self):
+        selector    = pacsretrieve.HitsSelector('a==1 or (b~x and not c<3)')
+        self.assertEqual(selector.keys(), set(['a', 'b', 'c']))
+
+    def test_errors(self):
+        for str_select in ['', 'a==', '==1', 'a 1', '(a==1', 'a==1)', 'a==1 b==2',
+                           'a==1 and', 'not', 'a~"("', 'a=="1']:
+            with self.assertRaises(ValueError, msg = str_select):
+                pacsretrieve.HitsSelector(str_select)
+
+
+class HitsSelectorEvaluateTest(unittest.TestCase):
+
+    l_select    = [
+        'Modality==MR',
+        'Modality!=MR',
+        'Modality==MR and StudyDate>=20180101',
+        'Modality==CT or Modality==US and PatientID==3',
+        '(Modality==CT or Modality==US) and PatientID==2',
+        'not Modality==MR',
+        'not SeriesDescription~T',
+        'SeriesDescription~"^T[12] "',
+        'NumberOfSeriesRelatedInstances>=40',
+        'NumberOfSeriesRelatedInstances<100',
+        'NumberOfSeriesRelatedInstances>abc',
+        'StudyDate<20180201 and not (PatientID==4)',
+        'SeriesDescription=="Doppler \\"A\\""',
+        'NoSuchKey==1 or Modality==US',
+        'not NoSuchKey==1',
+        'NumberOfSeriesRelatedInstances==192',
+        'NumberOfSeriesRelatedInstances!=192',
+        'PatientID==5 or StudyDate==20180110',
+    ]
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp()
+        self.table      = pacsretrieve.HitsTable(l_hits)
+        str_file        = os.path.join(self.str_dir, 'hits.db')
+        writer          = pacsretrieve.HitsDBWriter(str_file)
+        for row, d_hit in enumerate(l_hits):
+            writer.row_add('series', row, d_hit)
+        writer.close()
+        self.db         = sqlite3.connect(str_file)
+        pacsretrieve.HitsSelector.sqlFunctions_register(self.db)
+        self.s_column   = set([row[1] for row in self.db.execute('PRAGMA table_info(series)')])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.str_dir)
+
+    def rows_bruteForce(self, selector):
+        """
+        Evaluate <selector> hit by hit, as a reference.
+        """
+        s_row       = set()
+        for row, d_hit in enumerate(l_hits):
+            if self.hit_match(selector.tree, d_hit):
+                s_row.add(row)
+        return s_row
+
+    def hit_match(self, tree, d_hit):
+        if tree[0] == 'and':    return self.hit_match(tree[1], d_hit) and self.hit_match(tree[2], d_hit)
+        if tree[0] == 'or':     return self.hit_match(tree[1], d_hit) or self.hit_match(tree[2], d_hit)
+        if tree[0] == 'not':    return not self.hit_match(tree[1], d_hit)
+        value       = d_hit[tree[1]]['value'] if tree[1] in d_hit else None
+        return pacsretrieve.HitsSelector.value_compare(value, tree[2], tree[3])
+
+    def rows_sql(self, selector):
+        str_condition, l_param  = selector.sql_compile(self.s_column)
+        return set([row for (row,) in self.db.execute(
+                        'SELECT row FROM series WHERE %s' % str_condition, l_param)])
+
+    def test_table_and_sql_agree(self):
+        for str_select in self.l_select:
+            selector    = pacsretrieve.HitsSelector(str_select)
+            s_expected  = self.rows_bruteForce(selector)
+            self.assertEqual(selector.rows_select(self.table), s_expected, str_select)
+            self.assertEqual(self.rows_sql(selector), s_expected, str_select)
+
+    def test_expected_rows(self):
+        d_expected  = {
+            'Modality==MR':                                     {0, 1, 4, 5},
+            'Modality==MR and StudyDate>=20180101':             {0, 4, 5},
+            'Modality==CT or Modality==US and PatientID==3':    {2, 3},
+            '(Modality==CT or Modality==US) and PatientID==2':  {2},
+            'NumberOfSeriesRelatedInstances>=40':               {0, 1, 5},
+            'NumberOfSeriesRelatedInstances==192':              {0, 5},
+            'not NoSuchKey==1':                                 {0, 1, 2, 3, 4, 5},
+        }
+        for str_select, s_expected in d_expected.items():
+            selector    = pacsretrieve.HitsSelector(str_select)
+            self.assertEqual(selector.rows_select(self.table), s_expected, str_select)
+
+
+class IndexListParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app    = pacsretrieve.PacsRetrieveApp()
+
+    def test_parse(self):
+        self.assertEqual(self.app.indexList_parse('0,1,2'), ['0', '1', '2'])
+        self.assertEqual(self.app.indexList_parse(' 3, 1 ,2,'), ['3', '1', '2'])
+        self.assertEqual(self.app.indexList_parse(''), [])
+
+    def test_duplicates_dropped_in_first_seen_order(self):
+        self.assertEqual(self.app.indexList_parse('3,1,3,2,1'), ['3', '1', '2'])
+        self.assertEqual(self.app.indexList_parse('1,01'), ['1'])
+
+    def test_bad_index(self):
+        with self.assertRaises(ValueError):
+            self.app.indexList_parse('1,a')
+
+    def test_same_series_dropped(self):
+        # '-1' is the same hit as '6' in a table of 7 hits
+        self.app.d_queryRow     = {
+            6:  hit_make(SeriesInstanceUID = '1.2.6'),
+            -1: hit_make(SeriesInstanceUID = '1.2.6'),
+            1:  hit_make(SeriesInstanceUID = '1.2.1')
+        }
+        self.app.l_indexList    = self.app.indexList_parse('6,-1,1')
+        options                 = argparse.Namespace(
+                                    str_priorHitsTable  = 'results.json',
+                                    str_priorHitsDB     = '',
+                                    str_indexList       = '6,-1,1',
+                                    str_select          = '',
+                                    str_PACSservice     = 'orthanc')
+        self.app.retrieveMessage_checkAndConstructBase(options)
+        self.assertEqual(self.app.l_indexList, ['6', '1'])
+        self.assertEqual([d_msg['meta']['on']['series_uid'] for d_msg in self.app.l_dmsg],
+                         ['1.2.6', '1.2.1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
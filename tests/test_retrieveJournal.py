@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pacsretrieve import pacsretrieve
+
+
+class RetrieveJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp()
+        self.str_file   = os.path.join(self.str_dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.str_dir)
+
+    def lines_read(self):
+        with open(self.str_file, 'rb') as f:
+            return f.read().split(b'\n')
+
+    def test_last_state_wins(self):
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        journal.record('1.2.3', 'initiated')
+        journal.record('1.2.3', 'received')
+        journal.record('1.2.4', 'initiated')
+        journal.record('1.2.3', 'pulled', path = '/out/1.2.3', files = 10)
+        journal.close()
+
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        self.assertEqual(journal.state_get('1.2.3')['state'], 'pulled')
+        self.assertEqual(journal.state_get('1.2.3')['files'], 10)
+        self.assertEqual(journal.state_get('1.2.4')['state'], 'initiated')
+        self.assertEqual(journal.state_get('1.2.5'), {})
+        journal.close()
+
+    def test_partial_last_line(self):
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        journal.record('1.2.3', 'pulled', files = 10)
+        journal.record('1.2.4', 'initiated')
+        journal.close()
+        # A run killed in the middle of a write
+        with open(self.str_file, 'ab') as f:
+            f.write(b'{"series": "1.2.4", "state": "pul')
+
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        self.assertEqual(journal.state_get('1.2.3')['state'], 'pulled')
+        self.assertEqual(journal.state_get('1.2.4')['state'], 'initiated')
+        journal.record('1.2.4', 'received')
+        journal.close()
+
+        # The partial line is ended, so the next record is on a line of its own
+        l_line      = self.lines_read()
+        self.assertEqual(l_line[-1], b'')
+        self.assertEqual(json.loads(l_line[-2])['state'], 'received')
+        self.assertEqual(l_line[-3], b'{"series": "1.2.4", "state": "pul')
+
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        self.assertEqual(journal.state_get('1.2.4')['state'], 'received')
+        journal.close()
+
+    def test_garbage_lines_skipped(self):
+        with open(self.str_file, 'wb') as f:
+            f.write(b'not json\n[1, 2]\n{"state": "pulled"}\n\n')
+            f.write(json.dumps({'series': '1.2.3', 'state': 'pulled', 'time': 0}).encode() + b'\n')
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        self.assertEqual(list(journal.d_series), ['1.2.3'])
+        journal.close()
+
+    def test_clean_journal_not_padded(self):
+        journal     = pacsretrieve.RetrieveJournal(self.str_file)
+        journal.record('1.2.3', 'initiated')
+        journal.close()
+        pacsretrieve.RetrieveJournal(self.str_file).close()
+        self.assertEqual(len(self.lines_read()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()